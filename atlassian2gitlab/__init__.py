@@ -1,11 +1,28 @@
 __version__ = "0.5"
 
 
+attachment_buffer = 8 * 1024 * 1024
+cache_file = None
+http_pool_size = 10
+http_max_retries = 5
+http_backoff_factor = 0.5
+progress_interval = 10
+transform_processes = 0
+markdown_processes = 0
+profile = None
 gitlab_url = None
 gitlab_token = None
 gitlab_repo = None
 gitlab_flush = False
 gitlab_group_level = False
+gitlab_fast_colors = False
+gitlab_notes_in_flight = 1
+gitlab_uploads_in_flight = 4
+gitlab_dedupe_attachments = None
+gitlab_prefetch_users = False
+gitlab_destroy_project_on_flush = False
+gitlab_rate_limit = None
+gitlab_requests_in_flight = 16
 bitbucket_url = None
 bitbucket_repo = None
 bitbucket_username = None
@@ -16,6 +33,12 @@ jira_epic_type = None
 jira_username = None
 jira_password = None
 jira_link_to_source = True
+jira_page_size = 100
+workers = 1
+resume = False
+since = None
+export_path = None
+import_path = None
 
 
 storyPoint_map = {
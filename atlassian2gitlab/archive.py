@@ -0,0 +1,283 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from munch import Munch, munchify
+from . import managers
+from .progress import tracker
+
+
+logger = logging.getLogger('atlassian2gitlab')
+
+
+class ArchivedResource(Munch):
+    """
+    Jira resource read from the archive
+
+    Like a `jira.resources.Resource`, it is displayed by its name.
+
+    >>> str(munchify({'version': {'id': 1, 'name': '1.0'}},
+    ...              ArchivedResource).version)
+    '1.0'
+    """
+    READABLE_IDS = ('displayName', 'key', 'name', 'filename', 'value', 'id')
+
+    def __str__(self):
+        for name in self.READABLE_IDS:
+            if name in self:
+                return str(self[name])
+        return Munch.__repr__(self)
+
+
+class ArchivedAttachment(ArchivedResource):
+    """
+    Jira attachment read from the archive
+    """
+    def iter_content(self, chunk_size=64 * 1024):
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+
+class ArchivedIssue(object):
+    """
+    Jira issue read from the archive, looking like a `jira.resources.Issue`
+    """
+    def __init__(self, record, archive):
+        self.key = record['key']
+        self.raw = record['raw']
+        self._permalink = record['permalink']
+        self.fields = munchify(self.raw['fields'], ArchivedResource)
+        if self.fields.get('status'):
+            self.fields.status.raw = self.raw['fields']['status']
+        self.fields.attachment = [
+            ArchivedAttachment(a, path=archive.blob(a['sha256']))
+            for a in self.fields.get('attachment') or []]
+
+    def permalink(self):
+        return self._permalink
+
+
+class Archive(object):
+    """
+    Jira issues stored on disk, to be migrated again without Jira
+
+    The archive is a directory holding:
+
+    * `issues.jsonl.gz`: one JSON record by line for each issue
+    * `manifest.json`: the total of issues, the Jira fields, and the sprints
+      and issue type icons used by the issues
+    * `blobs/`: the attachments and icons, named by the SHA-256 of their
+      content, so a file attached many times is stored once
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def blob(self, digest):
+        return os.path.join(self.path, 'blobs', digest)
+
+    def store(self, chunks):
+        """
+        Store the content in the blobs, if not already there
+
+        Returns:
+            str: The SHA-256 of the content
+        """
+        h = hashlib.sha256()
+        blobs = os.path.join(self.path, 'blobs')
+        with tempfile.NamedTemporaryFile(dir=blobs, delete=False) as f:
+            for chunk in chunks:
+                h.update(chunk)
+                f.write(chunk)
+                tracker.count('attachment_bytes', len(chunk))
+        digest = h.hexdigest()
+        if os.path.exists(self.blob(digest)):
+            os.unlink(f.name)
+        else:
+            os.replace(f.name, self.blob(digest))
+        return digest
+
+    def write(self, issues):
+        """
+        Export the Jira issues, with their attachments
+
+        The previous content of the archive is replaced once the export is
+        done, the manifest is written last: an interrupted export leaves the
+        previous one readable. Attachments and icons already stored by the
+        previous export are not downloaded again. An issue failing to export
+        is skipped, and recorded in the manifest.
+
+        Returns:
+            int: The number of issues exported
+        """
+        import requests
+        from .clients import mount
+        session = mount(requests.Session())
+        jira_manager = managers.JiraManager()
+        os.makedirs(os.path.join(self.path, 'blobs'), exist_ok=True)
+        blobs, icons = self.previous()
+
+        sprints = {}
+        failed = []
+        total = 0
+        path = os.path.join(self.path, 'issues.jsonl.gz')
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+            for issue in issues:
+                try:
+                    record = self._record(issue, session, blobs, icons,
+                                          sprints)
+                except Exception as e:
+                    logger.warning('Skip issue %s: %s', issue.key, e)
+                    failed.append({'key': issue.key, 'error': str(e)})
+                    tracker.count('failed')
+                    continue
+                f.write(json.dumps(record) + '\n')
+                total += 1
+                tracker.count('issues')
+                logger.debug('Issue %s exported', issue.key)
+
+        jira_manager.getFieldId('Sprint')
+        manifest = os.path.join(self.path, 'manifest.json')
+        if os.path.exists(manifest):
+            os.unlink(manifest)
+        os.replace(path + '.tmp', path)
+        with open(manifest + '.tmp', 'w') as f:
+            json.dump({
+                'total': total,
+                'failed': failed,
+                'fields': jira_manager._fields,
+                'sprints': list(sprints.values()),
+                'icons': icons}, f)
+        os.replace(manifest + '.tmp', manifest)
+        return total
+
+    def _record(self, issue, session, blobs, icons, sprints):
+        """
+        Store the attachments and the icon of the issue, and return its
+        record
+
+        Returns:
+            dict
+        """
+        from .gl_resources import Issue
+        raw = issue.raw
+        attachments = getattr(issue.fields, 'attachment', None) or []
+        raws = raw['fields'].get('attachment') or []
+        digests = []
+        for a, a_raw in zip(attachments, raws):
+            digest = blobs.get(str(a_raw['id']))
+            if not digest:
+                digest = self.store(a.iter_content(64 * 1024))
+            digests.append(digest)
+
+        url = issue.fields.issuetype.iconUrl
+        if url not in icons:
+            r = session.get(url, stream=True)
+            r.raise_for_status()
+            icons[url] = {
+                'sha256': self.store(r.iter_content(64 * 1024)),
+                'content_type': r.headers.get('Content-Type')}
+
+        sprint = Issue().getSprint(issue.fields)
+        if sprint:
+            sprints.setdefault(sprint.id, sprint.raw)
+
+        for a_raw, digest in zip(raws, digests):
+            a_raw['sha256'] = digest
+            blobs[str(a_raw['id'])] = digest
+        return {
+            'key': issue.key,
+            'permalink': issue.permalink(),
+            'raw': raw}
+
+    def previous(self):
+        """
+        Return the blobs of the attachments of the previous export, by Jira
+        attachment id, and its icons
+
+        Jira attachments never change, only the blobs still stored are kept.
+
+        Returns:
+            tuple: The two dicts
+        """
+        blobs = {}
+        icons = {}
+        manifest = os.path.join(self.path, 'manifest.json')
+        path = os.path.join(self.path, 'issues.jsonl.gz')
+        if not (os.path.exists(manifest) and os.path.exists(path)):
+            return blobs, icons
+        try:
+            with open(manifest) as f:
+                icons = json.load(f)['icons']
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    fields = json.loads(line)['raw']['fields']
+                    for a in fields.get('attachment') or []:
+                        if a.get('sha256'):
+                            blobs[str(a['id'])] = a['sha256']
+        except (OSError, ValueError, KeyError) as e:
+            logger.debug('Previous export not reused: %s', e)
+            return {}, {}
+        stored = os.path.exists
+        return (
+            dict((id, d) for id, d in blobs.items() if stored(self.blob(d))),
+            dict((url, i) for url, i in icons.items()
+                 if stored(self.blob(i['sha256']))))
+
+    def read(self):
+        """
+        Stream the archived issues
+
+        The fields, sprints and colors of the icons are loaded first, so
+        Jira is never requested.
+
+        Returns:
+            atlassian2gitlab.archive.IssueReader
+        """
+        with open(os.path.join(self.path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest.get('failed'):
+            logger.warning('%d issues failed to be exported: %s',
+                           len(manifest['failed']),
+                           ', '.join(i['key'] for i in manifest['failed']))
+
+        jira_manager = managers.JiraManager()
+        jira_manager._fields = manifest['fields']
+        for sprint in manifest['sprints']:
+            jira_manager._sprints[int(sprint['id'])] = munchify(
+                sprint, ArchivedResource)
+
+        import shutil
+        from .gl_resources import Issue
+        cache = managers.GitlabManager().cache
+        for url, icon in manifest['icons'].items():
+            if cache.get('color', url):
+                continue
+            # SVG icons are rendered in place, the blob is left untouched
+            with tempfile.NamedTemporaryFile() as f:
+                shutil.copyfile(self.blob(icon['sha256']), f.name)
+                content_type = (icon['content_type'] or '').split(';')[0]
+                svg = content_type.strip() == 'image/svg+xml'
+                cache.set('color', url, Issue().getDominantColor(f.name, svg))
+
+        return IssueReader(self, manifest['total'])
+
+
+class IssueReader(object):
+    """
+    Iterate over the archived issues, line by line
+    """
+    def __init__(self, archive, total):
+        self._archive = archive
+        self.total = total
+
+    def __len__(self):
+        return self.total
+
+    def __iter__(self):
+        path = os.path.join(self._archive.path, 'issues.jsonl.gz')
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                yield ArchivedIssue(json.loads(line), self._archive)
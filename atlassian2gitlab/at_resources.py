@@ -1,12 +1,155 @@
 from . import managers
+from .profiling import profiler
+import atlassian2gitlab as a2g
+import functools
 import re
+import threading
+
+
+EMOTICONS = {
+    ':)': ':smiley:',
+    ':(': ':disappointed:',
+    ':P': ':yum:',
+    ':D': ':grin:',
+    ';)': ':wink:',
+    '(y)': ':thumbsup:',
+    '(n)': ':thumbsdown:',
+    '(i)': ':information_source:',
+    '(/)': ':white_check_mark:',
+    '(x)': ':x:',
+    '(!)': ':warning:',
+    '(+)': ':heavy_plus_sign:',
+    '(-)': ':heavy_minus_sign:',
+    '(?)': ':grey_question:',
+    '(on)': ':bulb:',
+    '(*)': ':star:',
+    '(*r)': ':star:',
+    '(*g)': ':star:',
+    '(*b)': ':star:',
+    '(*y)': ':star:',
+}
+
+# Patterns are compiled once, and applied in this order
+KEEP_BLOCKS = re.compile(r'\{(code|noformat).*?\}.*?\{\1\}', re.DOTALL)
+KEEP_LINKS = re.compile(r'\[.+?\]')
+KEEP_ATTACHMENTS = re.compile(r'!.+?!')
+RULER = re.compile(r'^-{4,}$', re.MULTILINE)
+LIST = re.compile(r'^([\*\#]+) ', re.MULTILINE)
+HEADING = re.compile(r'^h([1-6])\. (.*)$', re.MULTILINE)
+TABLE_HEADING = re.compile(r'^\|\|.+\|\|$', re.MULTILINE)
+TABLE_HEADING_CELL = re.compile(r'(?<=\|\|)([^|]*)(?=\|\|)')
+EMOTICON = re.compile('|'.join(
+    re.escape(e) for e in sorted(EMOTICONS, key=len, reverse=True)))
+INLINES = [
+    (re.compile(r'~([^\s~].+?[^\s~])~'), r'<sub>\1</sub>'),
+    (re.compile(r'\^([^\s\^].+?[^\s\^])\^'), r'<sup>\1</sup>'),
+    (re.compile(r'\?{2}(.+?)\?{2}'), r'\n-- \1\n'),
+    (re.compile(r'\*([^\s\*].+?[^\s\*])\*'), r'**\1**'),
+    (re.compile(r'(?<!\w)\-([^\s\-].+?[^\s\-])\-(?!\w)'), r'~~\1~~'),
+    (re.compile(r'\+([^\s\+].+?[^\s\+])\+'), r'__\1__'),
+    (re.compile(r'{{(.+?)}}'), r'`\1`'),
+    (re.compile(r'^>\s*bq\. (.*)$', re.MULTILINE), r'\> \1'),
+]
+QUOTE = re.compile(r'\{quote\}[\n\s]*(.*?)[\n\s]*\{quote\}', re.DOTALL)
+QUOTE_LINE = re.compile(r'^', re.MULTILINE)
+COLOR = re.compile(
+    r'\{color(?:\:[a-z]+?)?\}[\n\s]*(.*?)[\n\s]*\{color\}', re.DOTALL)
+BLANK_LINES = re.compile(r'\n{3,}')
+LINE_BREAK = re.compile(r'(?<=\S)\n{1}(?=\w)')
+
+# Kept parts are replaced by a placeholder during the conversion
+PLACEHOLDER = re.compile('\ue000(\\d+)\ue000')
+# Users and attachments left unresolved by a deferred conversion
+TOKEN = re.compile('\ue001(user|attachment)=([^\ue001]*)\ue001')
+LINK = re.compile(r'^\[(.*)\]$')
+ATTACHMENT = re.compile(r'^!([^|]*)(?:\|.*)?!$')
+BLOCK = re.compile(
+    r'^\{(code|noformat):?(?P<l>[a-z]*?)?\}\n*(?P<c>.+?)\n*\{\1\}$',
+    re.DOTALL)
+
+_pool = None
+_lock = threading.Lock()
+
+
+def pool():
+    """
+    Return the pool of `markdown_processes` processes, started at first call
+
+    Returns:
+        concurrent.futures.ProcessPoolExecutor
+    """
+    global _pool
+    with _lock:
+        if not _pool:
+            import atexit
+            from .concurrency import processPool
+            _pool = processPool(a2g.markdown_processes)
+            atexit.register(_pool.shutdown)
+    return _pool
+
+
+def convert(filenames, text):
+    """
+    Convert the text with a deferred converter, in a worker process
+
+    >>> text = convert(['a.png'], '*See* !a.png!')
+    >>> text == '**See** \ue001attachment=a.png\ue001'
+    True
+
+    Returns:
+        str
+    """
+    from munch import Munch
+    converter = AtlassianNotationConverter(deferred=True)
+    converter._attachments = [Munch(filename=f) for f in filenames]
+    return converter.toMarkdown(text)
 
 
 class AtlassianNotationConverter(object):
-    _attachments = []
-    _forLater = {}
+    """
+    Translate Atlassian notation to Markdown
+
+    A deferred converter does not use Gitlab: users and attachments are
+    left as tokens, resolved later by `resolve`. It can run in a worker
+    process, the parent process owns the caches and network clients.
+    """
+    def __init__(self, deferred=False):
+        self._attachments = []
+        self._converted = {}
+        self._forLater = []
+        self._deferred = deferred
+
+    def convertMany(self, texts, processes=None):
+        """
+        Convert the texts in a pool of processes
+
+        Regular expressions hold the GIL, texts are rather converted on every
+        core. Users and attachments come back as tokens, to be resolved by
+        `resolve` in this process.
+
+        Returns:
+            list
+        """
+        processes = processes or a2g.markdown_processes
+        filenames = [a.filename for a in self._attachments]
+        chunksize = max(len(texts) // (processes * 4), 1)
+        return list(pool().map(
+            functools.partial(convert, filenames), texts,
+            chunksize=chunksize))
+
+    def prepare(self, texts):
+        """
+        Convert the texts at once in the pool of processes, ahead of their
+        use by `toMarkdown`
+        """
+        texts = [t for t in set(texts) if t not in self._converted]
+        if texts:
+            self._converted.update(zip(texts, self.convertMany(texts)))
 
     def _attachmentsToMarkdown(self, match):
+        return self._attachmentToMarkdown(match.group(1))
+
+    def _attachmentToMarkdown(self, filename):
         """
         Upload attachment and return the Markdown link
 
@@ -14,16 +157,40 @@ class AtlassianNotationConverter(object):
             str
         """
         for a in self._attachments:
-            if a.filename == match.group(1):
+            if a.filename == filename:
+                if self._deferred:
+                    return '\ue001attachment=%s\ue001' % a.filename
                 return managers.GitlabManager().attachFile(a)['markdown']
         return ''
 
+    def findAttachments(self, texts):
+        """
+        Return the attachments referenced in the given texts, in Atlassian
+        notation or as tokens of a deferred conversion
+
+        >>> from munch import munchify
+        >>> converter = AtlassianNotationConverter()
+        >>> converter._attachments = [munchify({'filename': 'a.png'}),
+        ...                           munchify({'filename': 'b.png'})]
+        >>> [a.filename for a in converter.findAttachments(['See !b.png!'])]
+        ['b.png']
+
+        Returns:
+            list
+        """
+        return [a for a in self._attachments
+                if any('!' + a.filename in t or
+                       '\ue001attachment=' + a.filename in t
+                       for t in texts)]
+
     def _headingsToMarkdown(self, match):
         return '#' * int(match.group(1)) + ' ' + match.group(2) + '\n'
 
     def _linksToMarkdown(self, match):
         m = re.match('~', match.group(1))
         if m:
+            if self._deferred:
+                return '\ue001user=%s\ue001' % match.group(1)[1:]
             user = managers.GitlabManager().findUser(match.group(1)[1:])
             return '@{}'.format(user.username)
         m = re.match(r'^(.*?)\|([a-z]+?://.*?)$', match.group(1))
@@ -78,16 +245,17 @@ class AtlassianNotationConverter(object):
         >>> converter._quotesToMarkdown(match)
         '\\n> blah\\n> blah'
         """
-        return '\n' + re.sub(r'^', r'> ', match.group(1), flags=re.MULTILINE)
+        return '\n' + QUOTE_LINE.sub('> ', match.group(1))
 
     def _tableHeadingsToMarkdown(self, match):
         first = '\n\n|'
         second = '|'
-        for m in re.finditer(r'(?<=\|\|)([^|]*)(?=\|\|)', match.string):
+        for m in TABLE_HEADING_CELL.finditer(match.group(0)):
             first += m.group(1) + '|'
             second += '-' * len(m.group(1)) + '|'
         return first + '\n' + second
 
+    @profiler.timed('AtlassianNotationConverter.toMarkdown')
     def toMarkdown(self, text):
         """
         Translate Atlassian Notation to Markdown
@@ -140,105 +308,77 @@ class AtlassianNotationConverter(object):
         >>> converter.toMarkdown('||heading 1||heading 2||')
         '|heading 1|heading 2|\\n|---------|---------|'
         """
-        tmp = text.strip()
-        tmp = re.sub(r'\r\n', r'\n', tmp)
-        tmp = re.sub(r'\{(code|noformat).*?\}.*?\{\1\}',
-                     self._keepItForLater,
-                     tmp, flags=re.DOTALL)
-        tmp = re.sub(r'\[.+?\]',
-                     self._keepItForLater,
-                     tmp, flags=re.MULTILINE)
-        tmp = re.sub(r'!.+?!',
-                     self._keepItForLater,
-                     tmp, flags=re.MULTILINE)
-        text = ''
-        for line in re.split(r'\n', tmp):
-            text += line.strip() + '\n'
-
-        text = re.sub(r'^-{4,}$', r'---\n', text, flags=re.MULTILINE)
-
-        text = re.sub(r'^([\*\#]+) ',
-                      self._listsToMarkdown,
-                      text, flags=re.MULTILINE)
-        text = re.sub(r'^h([1-6])\. (.*)$',
-                      self._headingsToMarkdown,
-                      text, flags=re.MULTILINE)
-        text = re.sub(r'^\|\|.+\|\|$',
-                      self._tableHeadingsToMarkdown,
-                      text, flags=re.MULTILINE)
-
-        text = re.sub(r':\)', r':smiley:', text)
-        text = re.sub(r':\(', r':disappointed:', text)
-        text = re.sub(r':P', r':yum:', text)
-        text = re.sub(r':D', r':grin:', text)
-        text = re.sub(r';\)', r':wink:', text)
-        text = re.sub(r'\(y\)', r':thumbsup:', text)
-        text = re.sub(r'\(n\)', r':thumbsdown:', text)
-        text = re.sub(r'\(i\)', r':information_source:', text)
-        text = re.sub(r'\(/\)', r':white_check_mark:', text)
-        text = re.sub(r'\(x\)', r':x:', text)
-        text = re.sub(r'\(!\)', r':warning:', text)
-        text = re.sub(r'\(\+\)', r':heavy_plus_sign:', text)
-        text = re.sub(r'\(-\)', r':heavy_minus_sign:', text)
-        text = re.sub(r'\(\?\)', r':grey_question:', text)
-        text = re.sub(r'\(on\)', r':bulb:', text)
-        text = re.sub(r'\(\*[rgby]?\)', r':star:', text)
-
-        text = re.sub(r'~([^\s~].+?[^\s~])~',
-                      r'<sub>\1</sub>',
-                      text, flags=re.MULTILINE)
-        text = re.sub(r'\^([^\s\^].+?[^\s\^])\^',
-                      r'<sup>\1</sup>',
-                      text, flags=re.MULTILINE)
-        text = re.sub(r'\?{2}(.+?)\?{2}',
-                      r'\n-- \1\n',
-                      text, flags=re.MULTILINE)
-        text = re.sub(r'\*([^\s\*].+?[^\s\*])\*',
-                      r'**\1**',
-                      text, flags=re.MULTILINE)
-        text = re.sub(r'(?<!\w)\-([^\s\-].+?[^\s\-])\-(?!\w)',
-                      r'~~\1~~',
-                      text, flags=re.MULTILINE)
-        text = re.sub(r'\+([^\s\+].+?[^\s\+])\+',
-                      r'__\1__',
-                      text, flags=re.MULTILINE)
-        text = re.sub(r'{{(.+?)}}',
-                      r'`\1`',
-                      text, flags=re.MULTILINE)
-
-        text = re.sub(r'^>\s*bq\. (.*)$', r'\> \1', text, flags=re.MULTILINE)
-        text = re.sub(r'\{quote\}[\n\s]*(.*?)[\n\s]*\{quote\}',
-                      self._quotesToMarkdown, text, flags=re.DOTALL)
-        text = re.sub(r'\{color(?:\:[a-z]+?)?\}[\n\s]*(.*?)[\n\s]*\{color\}',
-                      r'\n> **\1**', text, flags=re.DOTALL)
-
-        text = re.sub(r'\n{3,}', r'\n\n', text)
-        text = re.sub(r'(?<=\S)\n{1}(?=\w)', r'  \n', text)
+        if text in self._converted:
+            return self.resolve(self._converted[text])
+        self._forLater = []
+        tmp = text.strip().replace('\r\n', '\n')
+        tmp = KEEP_BLOCKS.sub(self._keepItForLater, tmp)
+        tmp = KEEP_LINKS.sub(self._keepItForLater, tmp)
+        tmp = KEEP_ATTACHMENTS.sub(self._keepItForLater, tmp)
+        text = '\n'.join(line.strip() for line in tmp.split('\n')) + '\n'
+
+        text = RULER.sub('---\n', text)
+        text = LIST.sub(self._listsToMarkdown, text)
+        text = HEADING.sub(self._headingsToMarkdown, text)
+        text = TABLE_HEADING.sub(self._tableHeadingsToMarkdown, text)
+        text = EMOTICON.sub(lambda m: EMOTICONS[m.group(0)], text)
+        for pattern, repl in INLINES:
+            text = pattern.sub(repl, text)
+        text = QUOTE.sub(self._quotesToMarkdown, text)
+        text = COLOR.sub(r'\n> **\1**', text)
+
+        text = BLANK_LINES.sub('\n\n', text)
+        text = LINE_BREAK.sub('  \n', text)
 
         return self._postProcessInMarkdown(text).strip()
 
+    def resolve(self, text):
+        """
+        Resolve the users and attachments left by a deferred conversion
+
+        >>> from munch import munchify
+        >>> deferred = AtlassianNotationConverter(deferred=True)
+        >>> deferred._attachments = [munchify({'filename': 'a.png'})]
+        >>> text = deferred.toMarkdown('!a.png! for [~jdoe]')
+        >>> text == '\ue001attachment=a.png\ue001 for \ue001user=jdoe\ue001'
+        True
+
+        Returns:
+            str
+        """
+        def resolve(match):
+            kind, name = match.groups()
+            if kind == 'user':
+                user = managers.GitlabManager().findUser(name)
+                return '@{}'.format(user.username)
+            return self._attachmentToMarkdown(name)
+        return TOKEN.sub(resolve, text)
+
     def _keepItForLater(self, match):
-        key = '%' + str(len(self._forLater)) + '%'
-        self._forLater[key] = match.group(0)
-        return key
+        self._forLater.append(match.group(0))
+        return '\ue000%d\ue000' % (len(self._forLater) - 1)
 
     def _postProcessInMarkdown(self, text):
-        for search, string in self._forLater.items():
-            repl = string
-            repl = re.sub(r'^\[(.*)\]$', self._linksToMarkdown, repl)
-            repl = re.sub(
-                r'^!([^|]*)(?:\|.*)?!$',
-                self._attachmentsToMarkdown,
-                repl)
-            r = r'^\{(code|noformat):?(?P<l>[a-z]*?)?\}\n*(?P<c>.+?)\n*\{\1\}$'
-            repl = re.sub(
-                r,
-                r'\n```\g<l>\n\g<c>\n```',
-                repl,
-                flags=re.DOTALL
-            )
-            text = re.sub(re.escape(search), repl, text)
-        return text
+        """
+        Convert the parts kept for later and put them back, in one pass
+
+        A kept part can hold the placeholder of a previous one, it is restored
+        too. Placeholders of an other conversion are left as is.
+
+        >>> converter = AtlassianNotationConverter()
+        >>> converter._forLater = ['[Atlassian|http://atlassian.com]']
+        >>> converter._postProcessInMarkdown('See \ue0000\ue000 or \ue0001\ue000')
+        'See [Atlassian](http://atlassian.com) or \ue0001\ue000'
+        """
+        def restore(match):
+            n = int(match.group(1))
+            if n >= len(self._forLater):
+                return match.group(0)
+            repl = LINK.sub(self._linksToMarkdown, self._forLater[n])
+            repl = ATTACHMENT.sub(self._attachmentsToMarkdown, repl)
+            repl = BLOCK.sub(r'\n```\g<l>\n\g<c>\n```', repl)
+            return PLACEHOLDER.sub(restore, repl)
+        return PLACEHOLDER.sub(restore, text)
 
 
 class JiraNotationConverter(AtlassianNotationConverter):
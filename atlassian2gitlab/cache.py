@@ -0,0 +1,82 @@
+import json
+import sqlite3
+import threading
+from .exceptions import A2GException
+
+
+class Cache(object):
+    """
+    Key/value store persisted in a SQLite database
+
+    Values are serialized in JSON and sorted by kind, like `user`, `label` or
+    `attachment`. Without file, the cache only lives in memory.
+
+    >>> cache = Cache(':memory:')
+    >>> cache.set('user', 'jdoe', {'id': 1, 'username': 'john.doe'})
+    >>> cache.get('user', 'jdoe')
+    {'id': 1, 'username': 'john.doe'}
+    >>> cache.get('user', 'nobody') is None
+    True
+    >>> cache.clear('user')
+    >>> cache.get('user', 'jdoe') is None
+    True
+
+    Ids and uploads only make sense in one Gitlab project: the cache file is
+    bound to the scope it is first opened with, and refused for any other.
+
+    >>> cache = Cache(':memory:', scope='https://gitlab.com/group/project')
+    >>> cache.check('https://gitlab.com/group/other')  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    atlassian2gitlab.exceptions.A2GException: The cache file ... belongs to ...
+    """
+    def __init__(self, path=None, scope=None):
+        self.path = path or ':memory:'
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+            'PRIMARY KEY (kind, key))')
+        if scope:
+            self.check(scope)
+
+    def check(self, scope):
+        """
+        Bind the cache to the scope, or raise if bound to another one
+        """
+        bound = self.get('scope', 'gitlab')
+        if bound is None:
+            self.set('scope', 'gitlab', scope)
+        elif bound != scope:
+            raise A2GException(
+                "The cache file `{}' belongs to {}, not to {}".format(
+                    self.path, bound, scope))
+
+    def get(self, kind, key):
+        """
+        Return the cached value, None if not found
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value FROM cache WHERE kind = ? AND key = ?',
+                (kind, str(key))).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, kind, key, value):
+        with self._lock:
+            self._db.execute(
+                'REPLACE INTO cache (kind, key, value) VALUES (?, ?, ?)',
+                (kind, str(key), json.dumps(value)))
+
+    def clear(self, kind=None):
+        """
+        Forget every value of the given kind, or everything but the scope
+        """
+        with self._lock:
+            if kind:
+                self._db.execute('DELETE FROM cache WHERE kind = ?', (kind,))
+            else:
+                self._db.execute("DELETE FROM cache WHERE kind != 'scope'")
@@ -1,4 +1,5 @@
 import atlassian2gitlab as a2g
+from .profiling import profiler
 
 
 class Config(object):
@@ -17,13 +18,32 @@ class Config(object):
     ...     'url': 'http://my-jira.local',
     ...     'username': 'jdoe',
     ...     'password': 'secret',
-    ...     'link_to_source': 'No'}
+    ...     'link_to_source': 'No',
+    ...     'page_size': '50'}
     >>> config['story_points'] = {'5': '4'}
     >>> config['user_map'] = {'jira': 'gitlab'}
     >>> c = Config(config)
 
     >>> a2g.ssl_verify
     True
+    >>> a2g.cache_file is None
+    True
+    >>> a2g.attachment_buffer
+    8388608
+    >>> a2g.http_pool_size
+    10
+    >>> a2g.http_max_retries
+    5
+    >>> a2g.http_backoff_factor
+    0.5
+    >>> a2g.progress_interval
+    10
+    >>> a2g.profile is None
+    True
+    >>> a2g.transform_processes
+    0
+    >>> a2g.markdown_processes
+    0
     >>> a2g.gitlab_url
     'http://my-gitlab.local'
     >>> a2g.gitlab_token
@@ -32,6 +52,22 @@ class Config(object):
     'fake/project'
     >>> a2g.gitlab_group_level
     False
+    >>> a2g.gitlab_prefetch_users
+    False
+    >>> a2g.gitlab_fast_colors
+    False
+    >>> a2g.gitlab_notes_in_flight
+    1
+    >>> a2g.gitlab_uploads_in_flight
+    4
+    >>> a2g.gitlab_dedupe_attachments is None
+    True
+    >>> a2g.gitlab_destroy_project_on_flush
+    False
+    >>> a2g.gitlab_rate_limit is None
+    True
+    >>> a2g.gitlab_requests_in_flight
+    16
     >>> a2g.jira_jql
     'Project=PRO'
     >>> a2g.jira_url
@@ -42,6 +78,8 @@ class Config(object):
     'secret'
     >>> a2g.jira_link_to_source
     False
+    >>> a2g.jira_page_size
+    50
 
     If a section named `user_map` is present, we use it as a map for
     user conversion between the Atlassian suite and Gitlab.
@@ -61,6 +99,21 @@ class Config(object):
     def __init__(self, config):
         defaults = config['DEFAULT']
         a2g.ssl_verify = defaults.getboolean('ssl_verify', fallback=True)
+        a2g.cache_file = defaults.get('cache')
+        a2g.attachment_buffer = defaults.getint(
+            'attachment_buffer', fallback=8 * 1024 * 1024)
+        a2g.progress_interval = defaults.getint(
+            'progress_interval', fallback=10)
+        a2g.profile = defaults.get('profile')
+        profiler.enabled = a2g.profile is not None
+        a2g.transform_processes = defaults.getint(
+            'transform_processes', fallback=0)
+        a2g.markdown_processes = defaults.getint(
+            'markdown_processes', fallback=0)
+        a2g.http_pool_size = defaults.getint('pool_size', fallback=10)
+        a2g.http_max_retries = defaults.getint('max_retries', fallback=5)
+        a2g.http_backoff_factor = defaults.getfloat(
+            'backoff_factor', fallback=0.5)
         if 'story_points' in config:
             self.mapStoryPoints(config['story_points'])
         if 'user_map' in config:
@@ -75,6 +128,22 @@ class Config(object):
         a2g.gitlab_repo = gl_config.get('repo')
         a2g.gitlab_group_level = gl_config.getboolean(
             'group_level', fallback=False)
+        a2g.gitlab_prefetch_users = gl_config.getboolean(
+            'prefetch_users', fallback=False)
+        a2g.gitlab_fast_colors = gl_config.getboolean(
+            'fast_colors', fallback=False)
+        a2g.gitlab_notes_in_flight = gl_config.getint(
+            'notes_in_flight', fallback=1)
+        a2g.gitlab_uploads_in_flight = gl_config.getint(
+            'uploads_in_flight', fallback=4)
+        a2g.gitlab_dedupe_attachments = self.dedupeMode(
+            gl_config.get('dedupe_attachments', fallback='No'))
+        a2g.gitlab_destroy_project_on_flush = gl_config.getboolean(
+            'destroy_project_on_flush', fallback=False)
+        a2g.gitlab_rate_limit = gl_config.getfloat(
+            'rate_limit', fallback=None)
+        a2g.gitlab_requests_in_flight = gl_config.getint(
+            'requests_in_flight', fallback=16)
 
         if 'bitbucket' in config.keys():
             bb_config = config['bitbucket']
@@ -93,6 +162,36 @@ class Config(object):
             a2g.jira_password = ji_config.get('password')
             a2g.jira_link_to_source = ji_config.getboolean(
                 'link_to_source', fallback=True)
+            a2g.jira_page_size = ji_config.getint('page_size', fallback=100)
+
+    def dedupeMode(self, value):
+        """
+        Return the attachments deduplication mode
+
+        >>> import configparser
+        >>> config = configparser.ConfigParser()
+        >>> config['gitlab'] = {}
+        >>> c = Config(config)
+        >>> c.dedupeMode('Off') is None
+        True
+        >>> c.dedupeMode('Yes')
+        'content'
+        >>> c.dedupeMode('filename')
+        'filename'
+        >>> c.dedupeMode('filenames')
+        Traceback (most recent call last):
+        ...
+        ValueError: Unknown dedupe_attachments mode: filenames
+        """
+        value = value.lower()
+        if value in ('no', 'off', 'false', '0'):
+            return None
+        if value in ('yes', 'on', 'true', '1'):
+            return 'content'
+        if value not in ('content', 'filename'):
+            raise ValueError(
+                'Unknown dedupe_attachments mode: {}'.format(value))
+        return value
 
     def mapStoryPoints(self, dict):
         """
@@ -131,6 +230,33 @@ def configure(description):
         '-f', '--flush',
         help='Flush the Gitlab repo first',
         action='store_true')
+    parser.add_argument(
+        '-r', '--resume',
+        help='Resume an interrupted migration (needs a cache file)',
+        action='store_true')
+    parser.add_argument(
+        '-w', '--workers',
+        help='Number of issues migrated in parallel (default: 1)',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '-s', '--since',
+        help='Only migrate the issues updated since the date, or since the '
+             'last run without date, and update the ones already migrated '
+             '(needs a cache file)',
+        metavar='DATE',
+        nargs='?',
+        const='last')
+    parser.add_argument(
+        '-e', '--export',
+        help='Export the Jira issues to an archive, instead of migrating them',
+        metavar='ARCHIVE',
+        dest='export_path')
+    parser.add_argument(
+        '-i', '--import',
+        help='Migrate the issues from an archive, instead of Jira',
+        metavar='ARCHIVE',
+        dest='import_path')
     parser.add_argument(
         '-V', '--version',
         help='Show version and exit',
@@ -140,8 +266,26 @@ def configure(description):
 
     if args.flush:
         a2g.gitlab_flush = True
+    a2g.workers = args.workers
+    a2g.export_path = args.export_path
+    a2g.import_path = args.import_path
+    if args.export_path and args.import_path:
+        parser.error('--export and --import are exclusive')
 
     import configparser
     config = configparser.ConfigParser()
     config.read(args.config)
-    Config(config)
+    try:
+        Config(config)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.resume:
+        if not a2g.cache_file:
+            parser.error('--resume needs a cache file, set it in [DEFAULT]')
+        a2g.resume = True
+
+    if args.since:
+        if not a2g.cache_file:
+            parser.error('--since needs a cache file, set it in [DEFAULT]')
+        a2g.since = args.since
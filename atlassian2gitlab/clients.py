@@ -1,25 +1,282 @@
 import atlassian2gitlab as a2g
+import functools
+import random
+import re
 import requests
 from munch import munchify
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from urllib3.exceptions import NewConnectionError
+from urllib3.util.retry import Retry as BaseRetry
+from .concurrency import RateLimiter
+from .profiling import profiler
+from .progress import tracker
+
+
+TIMEOUT = 60
+
+
+def backoff(retry, response=None):
+    """
+    Return the delay before the next attempt
+
+    The `Retry-After` header of the response wins over the exponential
+    backoff.
+
+    >>> from munch import munchify
+    >>> backoff(0, munchify({'headers': {'Retry-After': '3'}}))
+    3.0
+    >>> 2 <= backoff(2, munchify({'headers': {}})) / a2g.http_backoff_factor <= 6
+    True
+    >>> 2 <= backoff(2) / a2g.http_backoff_factor <= 6
+    True
+
+    Returns:
+        float
+    """
+    after = response.headers.get('Retry-After') if response else None
+    if after and after.isdigit():
+        return float(after)
+    return a2g.http_backoff_factor * 2 ** retry * random.uniform(0.5, 1.5)
+
+
+def unsent(error):
+    """
+    Tell whether the request failed before being sent
+
+    Such a request can be sent again, even if it is not idempotent.
+
+    >>> unsent(requests.exceptions.ConnectTimeout())
+    True
+    >>> unsent(requests.exceptions.ConnectionError(
+    ...     NewConnectionError(None, 'Connection refused')))
+    True
+    >>> unsent(requests.exceptions.ReadTimeout())
+    False
+
+    Returns:
+        bool
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        reason = getattr(error.args[0], 'reason', error.args[0])
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+class Retry(BaseRetry):
+    """
+    Retry policy of the requests sent to the Atlassian suite and Gitlab
+
+    A rate limited request (429) is always retried, after the delay given by
+    the `Retry-After` header if any: the server did not process it. Bad
+    gateways and unavailable servers (502, 503, 504) are retried only for
+    idempotent methods, a POST may have been processed already.
+
+    >>> retry = Retry(total=3, status_forcelist=Retry.STATUSES)
+    >>> retry.is_retry('POST', 429)
+    True
+    >>> retry.is_retry('POST', 503)
+    False
+    >>> retry.is_retry('GET', 503)
+    True
+    >>> retry.is_retry('GET', 404)
+    False
+
+    With a rate limiter, the slot of the request is released while waiting
+    for the next attempt, then acquired again.
+    """
+    STATUSES = (429, 502, 503, 504)
+
+    def __init__(self, *args, **kwargs):
+        self.limiter = kwargs.pop('limiter', None)
+        super(Retry, self).__init__(*args, **kwargs)
+
+    def new(self, **kwargs):
+        kwargs.setdefault('limiter', self.limiter)
+        return super(Retry, self).new(**kwargs)
+
+    def sleep(self, response=None):
+        if not self.limiter:
+            return super(Retry, self).sleep(response)
+        self.limiter.release(
+            response.status if response else None,
+            response.headers if response else None)
+        try:
+            super(Retry, self).sleep(response)
+        finally:
+            self.limiter.acquire()
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 429 and self.total:
+            return True
+        return super(Retry, self).is_retry(
+            method, status_code, has_retry_after)
+
+    def get_backoff_time(self):
+        """
+        Return the exponential backoff time, with a random jitter
+
+        Workers throttled at the same time do not retry all together.
+
+        Returns:
+            float
+        """
+        backoff = super(Retry, self).get_backoff_time()
+        return backoff * random.uniform(0.5, 1.5)
+
+
+class TimedAdapter(HTTPAdapter):
+    """
+    Transport timing each request in the profile, by method and path
+
+    >>> from munch import munchify
+    >>> TimedAdapter.spanName(munchify({
+    ...     'method': 'POST',
+    ...     'url': 'https://my-gitlab.local/api/v4/projects/42/issues/7/notes'}))
+    'HTTP POST /api/v4/projects/:id/issues/:id/notes'
+    """
+    @staticmethod
+    def spanName(request):
+        path = re.sub(r'/\d+(?=/|$)', '/:id', urlparse(request.url).path)
+        return 'HTTP {} {}'.format(request.method, path)
+
+    def send(self, request, **kwargs):
+        if not profiler.enabled:
+            return super(TimedAdapter, self).send(request, **kwargs)
+        with profiler.span(self.spanName(request)):
+            return super(TimedAdapter, self).send(request, **kwargs)
+
+
+class ThrottledAdapter(TimedAdapter):
+    """
+    Transport waiting for the rate limiter before each request
+
+    The attempts retried by the transport release and acquire the slot
+    again, with their own status.
+    """
+    def __init__(self, limiter, **kwargs):
+        self.limiter = limiter
+        super(ThrottledAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.limiter.acquire()
+        status = None
+        headers = None
+        try:
+            response = super(ThrottledAdapter, self).send(request, **kwargs)
+            status = response.status_code
+            headers = response.headers
+            return response
+        finally:
+            self.limiter.release(status, headers)
+
+
+def mount(session, limiter=None, retries=True):
+    """
+    Mount the pooled and retrying transport on the session
+
+    Connections are kept alive and reused by the pool, responses are
+    compressed by default (`Accept-Encoding: gzip, deflate`). With a rate
+    limiter, requests wait for it before being sent. The latency of every
+    response is reported to the progress tracker. Requests with a body
+    read only once, like streamed uploads, can not be retried by the
+    transport.
+
+    >>> s = mount(requests.Session())
+    >>> s.get_adapter('https://my-gitlab.local').max_retries.total
+    5
+    >>> s = mount(requests.Session(), retries=False)
+    >>> s.get_adapter('https://my-gitlab.local').max_retries.total
+    0
+    >>> len(mount(s).hooks['response'])
+    1
+
+    Returns:
+        requests.Session
+    """
+    options = dict(
+        pool_connections=a2g.http_pool_size,
+        pool_maxsize=a2g.http_pool_size,
+        max_retries=Retry(
+            total=a2g.http_max_retries if retries else 0,
+            backoff_factor=a2g.http_backoff_factor,
+            status_forcelist=Retry.STATUSES,
+            raise_on_status=False,
+            limiter=limiter))
+    if limiter:
+        adapter = ThrottledAdapter(limiter, **options)
+    else:
+        adapter = TimedAdapter(**options)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if latency not in session.hooks['response']:
+        session.hooks['response'].append(latency)
+    return session
+
+
+def latency(response, *args, **kwargs):
+    """
+    Report the latency of the response to the progress tracker
+    """
+    tracker.latency(response.elapsed.total_seconds())
 
 
 session = requests.Session()
+# Uploads are streamed, they are retried by the caller
+upload_session = requests.Session()
 
 
 class Gitlab(object):
     __gitlab = None
+    limiter = None
 
     def __getattr__(self, name):
         if not self.__gitlab:
             import gitlab
+            if not Gitlab.limiter:
+                Gitlab.limiter = RateLimiter(
+                    a2g.gitlab_rate_limit, a2g.gitlab_requests_in_flight)
+                mount(session, Gitlab.limiter)
+                mount(upload_session, Gitlab.limiter, retries=False)
             self.__gitlab = gitlab.Gitlab(
                 a2g.gitlab_url,
                 private_token=a2g.gitlab_token,
                 ssl_verify=a2g.ssl_verify,
                 api_version=4,
-                session=session)
+                session=session,
+                retry_transient_errors=False)
+            # Retries are left to the transport, not stacked on top of it
+            self.__gitlab.http_request = functools.partial(
+                self.__gitlab.http_request,
+                obey_rate_limit=False, retry_transient_errors=False)
         return getattr(self.__gitlab, name)
 
+    def upload(self, project_id, filename, fileobj):
+        """
+        Upload a file to the project, streaming its content
+
+        python-gitlab loads the whole file in memory to build the request,
+        here the multipart body is encoded while it is sent. The body is read
+        once, the upload is not retried.
+
+        Returns:
+            dict: The ``alt``, ``url`` and ``markdown`` of the upload
+        """
+        from requests_toolbelt import MultipartEncoder
+        encoder = MultipartEncoder({'file': (filename, fileobj)})
+        r = upload_session.post(
+            '{}/projects/{}/uploads'.format(self.api_url, project_id),
+            data=encoder,
+            headers={
+                'Content-Type': encoder.content_type,
+                'PRIVATE-TOKEN': a2g.gitlab_token},
+            verify=a2g.ssl_verify,
+            timeout=TIMEOUT)
+        r.raise_for_status()
+        return r.json()
+
 
 class BitBucket(object):
     def __init__(self):
@@ -27,9 +284,10 @@ class BitBucket(object):
             self.api_url = 'https://api.bitbucket.org/1.0'
         else:
             self.api_url = '{}/rest/api/1.0'.format(a2g.bitbucket_url)
+        self.session = mount(requests.Session())
 
     def get(self, url):
-        r = requests.get(
+        r = self.session.get(
             self.api_url + url,
             auth=(a2g.bitbucket_username, a2g.bitbucket_password),
             headers={'Content-Type': 'application/json'})
@@ -46,5 +304,7 @@ class Jira(object):
             self.__jira = jira.JIRA(
                 a2g.jira_url,
                 options={'verify': a2g.ssl_verify},
-                basic_auth=(a2g.jira_username, a2g.jira_password))
+                basic_auth=(a2g.jira_username, a2g.jira_password),
+                max_retries=0)
+            mount(self.__jira._session)
         return getattr(self.__jira, name)
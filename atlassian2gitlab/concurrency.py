@@ -0,0 +1,182 @@
+import threading
+import time
+
+
+def processPool(workers):
+    """
+    Return a pool of processes started by spawn, not fork
+
+    A forked process inherits the locks held by the threads of the parent,
+    like the one of the profiler, and would wait for them forever. Before
+    Python 3.7 the pool can not be given a context, the start method of the
+    whole program is changed instead.
+
+    Returns:
+        concurrent.futures.ProcessPoolExecutor
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    try:
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'))
+    except TypeError:
+        multiprocessing.set_start_method('spawn', force=True)
+        return ProcessPoolExecutor(max_workers=workers)
+
+
+def imap(function, iterable, workers=1, backlog=None):
+    """
+    Apply the function to every item, using a pool of threads
+
+    With only one worker, items are processed in order, in the current
+    thread. Otherwise, no more than `backlog` items (twice the number of
+    workers by default) are waiting in the pool, so a lazy iterable is never
+    fully loaded in memory. Results are yielded as soon as they are
+    available, whatever the order.
+
+    >>> sorted(imap(lambda x: x * 2, range(5), workers=3))
+    [0, 2, 4, 6, 8]
+
+    Returns:
+        generator
+    """
+    if workers <= 1:
+        for item in iterable:
+            yield function(item)
+        return
+
+    from concurrent.futures import (
+        ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED)
+    backlog = backlog or workers * 2
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for item in iterable:
+            if len(pending) >= backlog:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(function, item))
+        for future in as_completed(pending):
+            yield future.result()
+
+
+class Locks(object):
+    """
+    Reentrant locks identified by a key
+
+    Used to avoid two threads creating the same Gitlab object.
+
+    >>> locks = Locks()
+    >>> with locks('label', 'Story'):
+    ...     with locks('label', 'Story'):
+    ...         pass
+    >>> locks('label', 'Story') is locks('label', 'Story')
+    True
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def __call__(self, *key):
+        with self._lock:
+            if key not in self._locks:
+                self._locks[key] = threading.RLock()
+            return self._locks[key]
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the rate and the number of requests in flight
+
+    Without a rate, only the number of requests in flight is limited. The
+    rate follows the `RateLimit-Remaining` and `RateLimit-Reset` headers sent
+    by Gitlab: the remaining requests are spread until the reset of the
+    window, never above the configured rate. The number of requests in flight
+    grows by one each time as many requests succeeded, and is halved with the
+    rate when a request is rate limited, whatever its headers.
+
+    >>> limiter = RateLimiter(rate=10, concurrency=4)
+    >>> limiter.acquire()
+    >>> limiter.release(429, {'RateLimit-Remaining': '600',
+    ...                       'RateLimit-Reset': str(time.time() + 60)})
+    >>> str(limiter)
+    '5.0 requests/s, 2 in flight max'
+    >>> limiter.acquire()
+    >>> limiter.release(200, {'RateLimit-Remaining': '120',
+    ...                       'RateLimit-Reset': str(time.time() + 60)})
+    >>> round(limiter.rate)
+    2
+    """
+    MIN_RATE = 0.1
+
+    def __init__(self, rate=None, concurrency=16):
+        self.rate = rate
+        self.maxRate = rate
+        self.concurrency = concurrency
+        self.limit = concurrency
+        self.inFlight = 0
+        self._tokens = 1.0
+        self._stamp = time.monotonic()
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def __str__(self):
+        rate = 'unlimited' if self.rate is None else '%.1f' % self.rate
+        return '%s requests/s, %d in flight max' % (rate, self.limit)
+
+    def acquire(self):
+        """
+        Wait for a token and a free slot
+        """
+        with self._cond:
+            while True:
+                timeout = None
+                if self.rate:
+                    now = time.monotonic()
+                    self._tokens = min(
+                        self._tokens + (now - self._stamp) * self.rate,
+                        max(self.limit, 1))
+                    self._stamp = now
+                    if self._tokens < 1:
+                        timeout = (1 - self._tokens) / self.rate
+                if self.inFlight < self.limit and timeout is None:
+                    if self.rate:
+                        self._tokens -= 1
+                    self.inFlight += 1
+                    return
+                self._cond.wait(timeout)
+
+    def release(self, status=None, headers=None):
+        """
+        Free the slot, and adapt to the response of the server
+        """
+        with self._cond:
+            self.inFlight -= 1
+            if status == 429:
+                self.limit = max(self.limit // 2, 1)
+                self._successes = 0
+                if self.rate:
+                    self.rate = max(self.rate / 2, self.MIN_RATE)
+            else:
+                self._successes += 1
+                if self._successes >= self.limit:
+                    self.limit = min(self.limit + 1, self.concurrency)
+                    self._successes = 0
+            if headers and status != 429:
+                self._follow(headers)
+            self._cond.notify_all()
+
+    def _follow(self, headers):
+        remaining = headers.get('RateLimit-Remaining')
+        reset = headers.get('RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        try:
+            window = max(float(reset) - time.time(), 1)
+            rate = int(remaining) / window
+        except ValueError:
+            return
+        if self.maxRate:
+            rate = min(rate, self.maxRate)
+        self.rate = max(rate, self.MIN_RATE)
@@ -1,17 +1,35 @@
+import contextlib
+import datetime
 import logging
+import time
 from dateutil.parser import parse
 import atlassian2gitlab as a2g
-from . import managers
-from .exceptions import NotFoundException
-from gitlab.exceptions import GitlabGetError
+from . import clients, managers
+from .concurrency import imap
+from .exceptions import A2GException, NotFoundException
+from .profiling import profiler
+from .progress import tracker
 
 
 logger = logging.getLogger('atlassian2gitlab')
 
 
+@contextlib.contextmanager
+def phase(name):
+    """
+    Follow a phase of the migration of an issue, in the progress report and
+    in the profile
+    """
+    with tracker.phase(name), profiler.span(name):
+        yield
+
+
 class Issue(object):
     def __init__(self):
         self._item = None
+        self._key = None
+        self._journal = {'phases': [], 'notes': []}
+        self._failedNotes = 0
         self._owner = None
         self.assignee_ids = []
         self.created_at = None
@@ -21,27 +39,166 @@ class Issue(object):
         self.title = None
         self.weight = 0
 
+    @profiler.timed('Issue.save')
     def save(self):
         """
-        Create the Gitlab issue (update not yet supported)
+        Create the Gitlab issue, or update it if migrated by a previous run
+
+        The existing issue is found by `findExisting`. Only the fields
+        changed since are sent, in one request.
         """
         project = managers.GitlabManager().project
+        data = {
+            'created_at': self.created_at,
+            'title': self.title,
+            'assignee_ids': self.assignee_ids,
+            'description': self.description,
+            'milestone_id': self.milestone_id,
+            'weight': self.weight,
+            'labels': self.labels}
         try:
-            self._item = project.issues.create({
-                'created_at': self.created_at,
-                'title': self.title,
-                'assignee_ids': self.assignee_ids,
-                'description': self.description,
-                'milestone_id': self.milestone_id,
-                'weight': self.weight,
-                'labels': self.labels},
-                sudo=self._owner)
-            logger.debug("Issue `{}' created (#{})".format(
-                self.title, self._item.iid))
+            if self.item or self.findExisting():
+                changes = self.changes(data)
+                if changes:
+                    project.issues.update(self.item.iid, changes)
+                    logger.debug("Issue #%d updated: %s", self.item.iid,
+                                 ', '.join(sorted(changes)))
+            else:
+                self._item = project.issues.create(data, sudo=self._owner)
+                logger.debug("Issue `{}' created (#{})".format(
+                    self.title, self._item.iid))
+            self._journal['iid'] = self._item.iid
+            self.done('issue')
         except Exception as e:
             logger.debug(str(e))
-            logger.error("Couldn't create issue `{}'".format(self.title))
+            logger.error("Couldn't save issue `{}'".format(self.title))
+            raise
+
+    def findExisting(self):
+        """
+        Find the Gitlab issue migrated by a previous run
+
+        It is found by the journal of the cache, even without `--resume`,
+        then adopted with the steps it records. Otherwise, with `--resume` or
+        `--since` only, it is searched by the link to the source: the search
+        API is heavily rate limited. It is not searched either if the project
+        has just been flushed, the comments were created before the link.
+
+        Returns:
+            bool
+        """
+        if not self._key:
+            return False
+        gl_manager = managers.GitlabManager()
+        project = gl_manager.project
+        journal = gl_manager.cache.get('journal', self._key)
+        if journal and 'iid' in journal:
+            try:
+                self._item = project.issues.get(journal['iid'])
+                self._journal = journal
+                return True
+            except Exception as e:
+                logger.debug("Issue #%d not found: %s", journal['iid'], e)
+
+        if not (a2g.resume or a2g.since) or not a2g.jira_link_to_source or \
+                a2g.gitlab_flush:
+            return False
+        marker = 'Imported from [{}]('.format(self._key)
+        # Every page is read, the note may be after the first ones
+        notes = project.search('notes', marker, iterator=True, per_page=100)
+        for note in notes:
+            if note.get('noteable_type') == 'Issue' and \
+                    note['body'].startswith(marker):
+                self._item = project.issues.get(note['noteable_iid'])
+                for phase in ('notes', 'link'):
+                    if not self.isDone(phase):
+                        self._journal['phases'].append(phase)
+                return True
+        return False
+
+    def changes(self, data):
+        """
+        Return the fields of the data differing from the Gitlab issue
+
+        The creation date can not be changed.
+
+        >>> from munch import munchify
+        >>> issue = Issue()
+        >>> issue._item = munchify({
+        ...     'title': 'Title', 'description': '', 'assignees': [{'id': 1}],
+        ...     'milestone': None, 'weight': None, 'labels': ['b', 'a']})
+        >>> issue.changes({
+        ...     'created_at': '2008-04-12T21:00:00', 'title': 'New title',
+        ...     'assignee_ids': [1], 'description': None, 'milestone_id': 2,
+        ...     'weight': 0, 'labels': ['a', 'b']})
+        {'title': 'New title', 'milestone_id': 2}
 
+        Returns:
+            dict
+        """
+        item = self.item
+        current = {
+            'title': item.title,
+            'assignee_ids': sorted(a['id'] for a in item.assignees or []),
+            'description': item.description or None,
+            'milestone_id': item.milestone['id'] if item.milestone else None,
+            'weight': item.weight or 0,
+            'labels': sorted(item.labels)}
+        changes = {}
+        for name, value in data.items():
+            if name not in current:
+                continue
+            compared = sorted(value) if isinstance(value, list) else value
+            if name == 'description':
+                compared = value or None
+            elif name == 'weight':
+                compared = value or 0
+            if compared != current[name]:
+                changes[name] = value
+        return changes
+
+    def resume(self, key):
+        """
+        Load the journal of a previous migration of the Jira issue
+
+        The journal is kept in the cache, it records the Gitlab issue iid
+        and the phases already done: `issue`, `notes`, `link` and `close`,
+        with the ids of the Jira comments already migrated. Without the `--resume` or `--since` options, the migration starts
+        from scratch.
+        """
+        self._key = key
+        if a2g.resume or a2g.since:
+            journal = managers.GitlabManager().cache.get('journal', key)
+            if journal:
+                self._journal = journal
+
+    def isDone(self, phase):
+        return phase in self._journal['phases']
+
+    def done(self, phase=None):
+        """
+        Record the phase as done in the journal
+        """
+        if phase and not self.isDone(phase):
+            self._journal['phases'].append(phase)
+        if self._key:
+            managers.GitlabManager().cache.set(
+                'journal', self._key, self._journal)
+
+    @property
+    def item(self):
+        """
+        Return the Gitlab issue, fetched by iid if created in a previous run
+
+        Returns:
+            gitlab.v4.objects.ProjectIssue
+        """
+        if not self._item and 'iid' in self._journal:
+            project = managers.GitlabManager().project
+            self._item = project.issues.get(self._journal['iid'])
+        return self._item
+
+    @profiler.timed('Issue.getSprint')
     def getSprint(self, fields):
         """
         Parse Sprints customfield and format it
@@ -56,32 +213,82 @@ class Issue(object):
             import re
             m = re.search(r'id=(\d+),', sprints[-1])
             id = m.group(1)
-            return manager.jira.sprint(id)
+            m = re.search(r'rapidViewId=(\d+)', sprints[-1])
+            board_id = m.group(1) if m else None
+            return manager.findSprint(id, board_id)
 
+    @profiler.timed('Issue.getDominantColorFromUrl')
     def getDominantColorFromUrl(self, url):
+        """
+        Return the dominant color of the image, in hexadecimal
+
+        Colors are cached by URL and by image content, as many issue types
+        share the same icon.
+
+        Returns:
+            str
+        """
+        import hashlib
         import os
         import urllib.request
+        manager = managers.GitlabManager()
+        with manager.lock('color', url):
+            color = manager.cache.get('color', url)
+            if color:
+                return color
+
+            tmpfile, headers = urllib.request.urlretrieve(url)
+            with open(tmpfile, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            color = manager.cache.get('color', digest)
+            if not color:
+                svg = headers.get_content_type() == 'image/svg+xml'
+                color = self.getDominantColor(tmpfile, svg)
+                manager.cache.set('color', digest, color)
+            os.unlink(tmpfile)
+            manager.cache.set('color', url, color)
+        return color
+
+    def getDominantColor(self, path, svg=False):
+        """
+        Return the dominant color of the image file, in hexadecimal
+
+        In fast mode, the image is downsampled before being quantized.
+
+        Returns:
+            str
+        """
         from colorthief import ColorThief
-        tmpfile, headers = urllib.request.urlretrieve(url)
-        if headers.get_content_type() == 'image/svg+xml':
+        if svg:
             from svglib.svglib import svg2rlg
             from reportlab.graphics import renderPM
-            drawing = svg2rlg(tmpfile)
-            renderPM.drawToFile(drawing, tmpfile)
-        color = ColorThief(tmpfile).get_color(quality=1)
-        os.unlink(tmpfile)
+            drawing = svg2rlg(path)
+            renderPM.drawToFile(drawing, path)
+        image = path
+        if a2g.gitlab_fast_colors:
+            import io
+            from PIL import Image
+            thumbnail = Image.open(path)
+            thumbnail.thumbnail((64, 64))
+            image = io.BytesIO()
+            thumbnail.convert('RGBA').save(image, 'PNG')
+            image.seek(0)
+        color = ColorThief(image).get_color(quality=1)
         return '#%02x%02x%02x' % color
 
+    @profiler.timed('Issue.addLabel')
     def addLabel(self, name, colorname=None, iconUrl=None):
-        label = managers.GitlabManager().findLabel(name)
-        if not label.color:
-            if colorname:
-                import webcolors
-                label.color = webcolors.name_to_hex(colorname)
-            elif iconUrl:
-                label.color = self.getDominantColorFromUrl(iconUrl)
-            if label.color:
-                label.save()
+        gl_manager = managers.GitlabManager()
+        with gl_manager.lock('label', name):
+            label = gl_manager.findLabel(name)
+            if not label.color:
+                if colorname:
+                    import webcolors
+                    label.color = webcolors.name_to_hex(colorname)
+                elif iconUrl:
+                    label.color = self.getDominantColorFromUrl(iconUrl)
+                if label.color:
+                    label.save()
         if name not in self.labels:
             self.labels.append(name)
         return label
@@ -94,19 +301,30 @@ class Issue(object):
             name = status.name
             colorname = status.raw['statusCategory']['colorName'].split('-')[0]
             label = self.addLabel(name, colorname=colorname)
-            board = managers.GitlabManager().findBoard()
-            if not [l.label['name'] for l in board.lists.list()].count(name):
-                board.lists.create({'label_id': label.id})
-                logger.debug("Add label `%s' to the board", name)
+            managers.GitlabManager().addBoardList(label)
+
+    @profiler.timed('Issue.setMilestone')
+    def setMilestone(self, title, state, due_date=None):
+        gl_manager = managers.GitlabManager()
+        with gl_manager.lock('milestone', title):
+            milestone = gl_manager.findMilestone(title)
+            milestone._fill(state, due_date)
+        self.milestone_id = milestone.id
 
+    @profiler.timed('Issue.setMilestoneFromSprint')
     def setMilestoneFromSprint(self, sprint):
-        milestone = managers.GitlabManager().findMilestone(str(sprint))
-        milestone.fillFromJiraSprint(sprint)
+        gl_manager = managers.GitlabManager()
+        with gl_manager.lock('milestone', str(sprint)):
+            milestone = gl_manager.findMilestone(str(sprint))
+            milestone.fillFromJiraSprint(sprint)
         self.milestone_id = milestone.id
 
+    @profiler.timed('Issue.setMilestoneFromVersion')
     def setMilestoneFromVersion(self, version):
-        milestone = managers.GitlabManager().findMilestone(str(version))
-        milestone.fillFromJiraVersion(version)
+        gl_manager = managers.GitlabManager()
+        with gl_manager.lock('milestone', str(version)):
+            milestone = gl_manager.findMilestone(str(version))
+            milestone.fillFromJiraVersion(version)
         self.milestone_id = milestone.id
 
     def getWeight(self, number):
@@ -140,10 +358,286 @@ class Issue(object):
     def fillFromJira(self, jira_issue):
         from atlassian2gitlab.at_resources import JiraNotationConverter
         converter = JiraNotationConverter(jira_issue)
-        jira_manager = managers.JiraManager()
         gl_manager = managers.GitlabManager()
         fields = jira_issue.fields
 
+        self.resume(jira_issue.key)
+
+        comments = fields.comment.comments if hasattr(fields, 'comment') \
+            else []
+        texts = []
+        if fields.description and not self.isDone('issue'):
+            texts.append(fields.description)
+        texts.extend(c.body for c in comments
+                     if c.id not in self._journal['notes'])
+        with phase('attachments'):
+            gl_manager.prefetchAttachments(converter.findAttachments(texts))
+        if a2g.markdown_processes > 0:
+            with phase('markdown'):
+                converter.prepare(texts)
+
+        if a2g.since and self.isDone('issue'):
+            self.updateFromJira(converter, jira_issue)
+            return
+
+        if not self.isDone('issue'):
+            with phase('issue'):
+                self.fillFieldsFromJira(converter, fields)
+                self.save()
+
+        if hasattr(fields, 'comment') and not self.isDone('notes'):
+            with phase('notes'):
+                self.addNotesFromJira(converter, fields.comment.comments)
+
+        if a2g.jira_link_to_source and not self.isDone('link'):
+            with phase('link'):
+                self.addSourceLink(jira_issue.key, jira_issue.permalink())
+
+        if fields.resolution and not self.isDone('close'):
+            with phase('close'):
+                self.close(parse(fields.resolutiondate).isoformat())
+        self.checkNotes()
+
+    def updateFromJira(self, converter, jira_issue):
+        """
+        Bring the Gitlab issue migrated by a previous run up to date
+
+        The fields changed in Jira, labels included, are sent in one request,
+        the new comments are added, and the issue is closed or reopened like
+        in Jira.
+        """
+        fields = jira_issue.fields
+        comments = fields.comment.comments if hasattr(fields, 'comment') \
+            else []
+
+        with phase('issue'):
+            self.fillFieldsFromJira(converter, fields)
+            self.save()
+
+        if any(c.id not in self._journal['notes'] for c in comments):
+            with phase('notes'):
+                self.addNotesFromJira(converter, comments)
+
+        if a2g.jira_link_to_source and not self.isDone('link'):
+            with phase('link'):
+                self.addSourceLink(jira_issue.key, jira_issue.permalink())
+
+        with phase('close'):
+            if fields.resolution and self.item.state != 'closed':
+                self.close(parse(fields.resolutiondate).isoformat())
+            elif not fields.resolution and self.item.state == 'closed':
+                self.reopen()
+        self.checkNotes()
+
+    def checkNotes(self):
+        """
+        Raise if comments could not be created
+
+        The issue is then counted as failed: the next `--since` run does not
+        read it again otherwise, unless updated in Jira.
+        """
+        if self._failedNotes:
+            raise A2GException('{} comments not created'.format(
+                self._failedNotes))
+
+    def fillFromPayload(self, jira_issue, payload):
+        """
+        Migrate the issue from the payload built by the pipeline
+
+        The payload is plain data computed from the Jira issue in a worker
+        process, only users and attachments are still to be resolved.
+        """
+        from atlassian2gitlab.at_resources import JiraNotationConverter
+        converter = JiraNotationConverter(jira_issue)
+        gl_manager = managers.GitlabManager()
+
+        self.resume(payload['key'])
+        if a2g.since and self.isDone('issue'):
+            # Migrated by a previous run, updated like without pipeline
+            self.updateFromJira(converter, jira_issue)
+            return
+
+        texts = []
+        if payload['description'] and not self.isDone('issue'):
+            texts.append(payload['description'])
+        if not self.isDone('notes'):
+            texts.extend(note['body'] for note in payload['notes']
+                         if note['id'] not in self._journal['notes'])
+        with phase('attachments'):
+            gl_manager.prefetchAttachments(converter.findAttachments(texts))
+
+        if not self.isDone('issue'):
+            with phase('issue'):
+                self.created_at = payload['created_at']
+                self.title = payload['title']
+                if payload['reporter']:
+                    self._owner = gl_manager.findUser(
+                        payload['reporter']).username
+                if payload['assignee']:
+                    self.assignee_ids = [
+                        gl_manager.findUser(payload['assignee']).id]
+                if payload['description']:
+                    self.description = converter.resolve(
+                        payload['description'])
+                if payload['milestone']:
+                    self.setMilestone(**payload['milestone'])
+                self.weight = payload['weight']
+                for label in payload['labels']:
+                    added = self.addLabel(
+                        label['name'], label.get('colorname'),
+                        label.get('iconUrl'))
+                    if label.get('board'):
+                        gl_manager.addBoardList(added)
+                self.save()
+
+        if not self.isDone('notes'):
+            with phase('notes'):
+                notes = []
+                for note in payload['notes']:
+                    if note['id'] in self._journal['notes']:
+                        continue
+                    user = gl_manager.findUser(note['author'])
+                    notes.append((note['id'], user.username, {
+                        'body': converter.resolve(note['body']),
+                        'created_at': note['created_at']}))
+                self.sendNotes(notes)
+
+        if a2g.jira_link_to_source and not self.isDone('link'):
+            with phase('link'):
+                self.addSourceLink(payload['key'], payload['permalink'])
+
+        if payload['closed_at'] and not self.isDone('close'):
+            with phase('close'):
+                self.close(payload['closed_at'])
+        self.checkNotes()
+
+    def addSourceLink(self, key, url):
+        self.item.notes.create({
+            'body': 'Imported from [{}]({})'.format(key, url)})
+        self.done('link')
+
+    def close(self, closed_at):
+        self.item.state_event = 'close'
+        self.item.updated_at = closed_at
+        self.item.save()
+        logger.debug("Close issue #%d", self.item.iid)
+        self.done('close')
+
+    def reopen(self):
+        self.item.state_event = 'reopen'
+        self.item.save()
+        logger.debug("Reopen issue #%d", self.item.iid)
+        if self.isDone('close'):
+            self._journal['phases'].remove('close')
+        self.done()
+
+    def addNotesFromJira(self, converter, comments):
+        """
+        Convert every Jira comment first, then create the notes
+
+        The comments already migrated are known by their id in the journal,
+        so a comment deleted in Jira does not shift the others.
+        """
+        gl_manager = managers.GitlabManager()
+        notes = []
+        for comment in comments:
+            if comment.id in self._journal['notes']:
+                continue
+            user = gl_manager.findUser(comment.author.key)
+            notes.append((comment.id, user.username, {
+                'body': converter.toMarkdown(comment.body),
+                'created_at': parse(comment.created).isoformat()}))
+        self.sendNotes(notes)
+
+    def sendNotes(self, notes):
+        """
+        Create the notes concurrently
+
+        No more than `notes_in_flight` notes are sent at the same time. Each
+        note keeps the creation date of its comment, so the thread is still
+        sorted by date, if the token owner is an admin. A failed note does
+        not abort the others, it is retried on its own by `addNote`, then
+        left to the next `--resume`, and the issue fails in the end.
+
+        Args:
+            list: Tuples of the comment id, the author username and
+                the data
+        """
+        # Fetched once before notes are sent from several threads
+        self.item
+        failed = 0
+        sent = imap(self.addNote, notes, a2g.gitlab_notes_in_flight)
+        for n, username, created in sent:
+            if created:
+                self._journal['notes'].append(n)
+                self.done()
+                tracker.count('notes')
+            else:
+                failed += 1
+                logger.warn("Unable to add a comment from `%s'", username)
+        self._failedNotes = failed
+        if not failed:
+            self.done('notes')
+
+    @profiler.timed('Issue.addNote')
+    def addNote(self, note):
+        """
+        Create the note, retried with backoff when safe
+
+        A note is sent again only if the request failed before being sent,
+        or if the server failed (5xx) without creating it: the notes of the
+        issue are checked first. Other failures are not retried, the note
+        may have been created.
+
+        Args:
+            tuple: The comment id, the author username and the data
+
+        Returns:
+            tuple: The comment id, the author username and
+                whether the note has been created
+        """
+        n, username, data = note
+        retry = 0
+        while True:
+            try:
+                self.item.notes.create(data, sudo=username)
+                return n, username, True
+            except Exception as e:
+                logger.debug("Comment %s not created: %s", n, e)
+                error = e
+            failed = (getattr(error, 'response_code', None) or 0) >= 500
+            if retry >= a2g.http_max_retries or \
+                    not (failed or clients.unsent(error)):
+                return n, username, False
+            time.sleep(clients.backoff(retry))
+            if failed and self.hasNote(data):
+                return n, username, True
+            retry += 1
+
+    def hasNote(self, data):
+        """
+        Tell whether the Gitlab issue has a note with the same body and date
+
+        Returns:
+            bool
+        """
+        def utc(date):
+            date = parse(date)
+            if date.tzinfo:
+                date = date.astimezone(datetime.timezone.utc)
+            return date.replace(tzinfo=None)
+
+        created_at = utc(data['created_at'])
+        for note in self.item.notes.list(iterator=True, per_page=100):
+            if note.body == data['body'] and \
+                    utc(note.created_at) == created_at:
+                return True
+        return False
+
+    def fillFieldsFromJira(self, converter, fields):
+        jira_manager = managers.JiraManager()
+        gl_manager = managers.GitlabManager()
+
         self.created_at = parse(fields.created).isoformat()
         self.title = fields.summary
 
@@ -167,6 +661,9 @@ class Issue(object):
         if hasattr(fields, spField) and getattr(fields, spField):
             self.weight = self.getWeight(getattr(fields, spField))
 
+        self.addLabelsFromJira(fields)
+
+    def addLabelsFromJira(self, fields):
         if len(fields.labels):
             for label in fields.labels:
                 self.addLabel(label)
@@ -174,52 +671,36 @@ class Issue(object):
         self.addLabelFromIssueType(fields.issuetype)
         if not fields.resolution:
             self.addLabelFromStatus(fields.status)
-        self.save()
-
-        if hasattr(fields, 'comment'):
-            try:
-                for comment in fields.comment.comments:
-                    data = {
-                        'body': converter.toMarkdown(comment.body),
-                        'created_at': parse(comment.created).isoformat()}
-                    user = gl_manager.findUser(comment.author.key)
-                    self._item.notes.create(data, sudo=user.username)
-            except Exception as e:
-                logger.warn("Unable to add a comment from `%s'", user.username)
-
-        if a2g.jira_link_to_source:
-            key = jira_issue.key
-            url = jira_issue.permalink()
-            self._item.notes.create({
-                'body': 'Imported from [{}]({})'.format(key, url)})
-
-        if fields.resolution:
-            self._item.state_event = 'close'
-            self._item.updated_at = parse(fields.resolutiondate).isoformat()
-            self._item.save()
-            logger.debug("Close issue #%d", self._item.iid)
 
 
 class Label(object):
     _item = None
 
-    def __init__(self, name):
+    def __init__(self, name, item=None):
         self.name = name
         self.color = None
-        try:
-            self._item = managers.GitlabManager().project.labels.get(name)
-            self.color = self._item.color
-        except GitlabGetError:
-            pass
+        if not item:
+            item = managers.GitlabManager().labelIndex.get(name)
+            if not item:
+                return
+        self._item = item
+        self.color = self._item.color
+        self._cache()
 
     @property
     def id(self):
         return self._item.id
 
+    def _cache(self):
+        managers.GitlabManager().cache.set('label', self.name, {
+            'id': self._item.id, 'name': self.name, 'color': self.color})
+
     def save(self):
         if not self._item:
-            self._item = managers.GitlabManager().project.labels.create({
+            manager = managers.GitlabManager()
+            self._item = manager.project.labels.create({
                 'name': self.name, 'color': self.color})
+            manager.labelIndex[self.name] = self._item
             logger.debug("Label `{}' created with `{}' color".format(
                 self.name, self.color))
         else:
@@ -227,6 +708,7 @@ class Label(object):
             self._item.save()
             logger.debug("Label `{}' updated with `{}' color".format(
                 self.name, self.color))
+        self._cache()
 
 
 class Project(object):
@@ -248,6 +730,17 @@ class Project(object):
     def __getattr__(self, name):
         return getattr(self._item, name)
 
+    def loadIssue(self, jira_issue, payload):
+        """
+        Create an issue from the payload built by the pipeline
+
+        Returns:
+            atlassian2gitlab.gl_resources.Issue
+        """
+        issue = Issue()
+        issue.fillFromPayload(jira_issue, payload)
+        return issue
+
     def addIssue(self, jira_issue):
         """
         Create an issue from a Jira issue object
@@ -262,136 +755,262 @@ class Project(object):
         issue.fillFromJira(jira_issue)
         return issue
 
+    # Objects deleted by a flush, with the attribute naming them. Each group
+    # is deleted concurrently with the others, the kinds of a group in turn.
+    FLUSH_GROUPS = [
+        [('issues', 'Issue', 'id')],
+        [('labels', 'Label', 'name')],
+        [('milestones', 'Milestone', 'title')],
+        [('tags', 'Tag', 'name'), ('branches', 'Branch', 'name')],
+    ]
+    FLUSH_PAGE = 100
+
     def flush(self):
-        tags = self._item.tags.list(all=True)
-        branches = self._item.branches.list(all=True)
-        issues = self._item.issues.list(all=True)
-        labels = self._item.labels.list(all=True)
-        milestones = self._item.milestones.list(all=True)
-
-        git_items = len(tags) + len(branches)
-        iss_items = len(issues) + len(milestones) + len(labels)
-        if git_items + iss_items == 0:
-            logger.info('Nothing to do')
+        """
+        Delete the issues, labels, milestones, tags and branches
+
+        With `destroy_project_on_flush`, the project is deleted and created
+        again when allowed, otherwise every object is deleted by the workers:
+        the groups share them.
+        """
+        cache = managers.GitlabManager().cache
+        for kind in ('label', 'milestone', 'journal', 'sync'):
+            cache.clear(kind)
+
+        if a2g.gitlab_destroy_project_on_flush and self.recreate():
+            # Uploads belong to the deleted project
+            for kind in ('attachment', 'upload_hash', 'upload_name'):
+                cache.clear(kind)
             return self
 
-        if len(issues):
-            total = len(issues)
-            logger.info('%d issues to be deleted', total)
-            i = 0
-            for issue in issues:
-                try:
-                    issue.delete()
-                    i += 1
-                except Exception as e:
-                    logger.warn("Issue `%s' has not been deleted: %s",
-                                issue.id, e)
-
-            if i == total:
-                logger.info('Done')
-            elif i == 0:
-                logger.error('Any issues deleted')
-            else:
-                logger.warn('%d/%d issues deleted', i, total)
-
-        if len(labels):
-            total = len(labels)
-            logger.info('%d labels to be deleted', total)
-            i = 0
-            for l in labels:
-                try:
-                    l.delete()
-                    i += 1
-                except Exception as e:
-                    logger.warn("Label `%s' has not been deleted: %s",
-                                l.name, e)
-
-            if i == total:
-                logger.info('Done')
-            elif i == 0:
-                logger.error('Any labels deleted')
-            else:
-                logger.warn('%d/%d labels deleted', i, total)
-
-        if len(milestones):
-            total = len(milestones)
-            logger.info('%d milestones to be deleted', total)
-            i = 0
-            for m in milestones:
-                try:
-                    m.delete()
-                    i += 1
-                except Exception as e:
-                    logger.warn("Milestone `%s' has not been deleted: %s",
-                                m.title, e)
-
-            if i == total:
-                logger.info('Done')
-            elif i == 0:
-                logger.error('Any milestones deleted')
-            else:
-                logger.warn('%d/%d milestones deleted', i, total)
-
-        if len(tags):
-            total = len(tags)
-            logger.info('%d tags to be deleted', total)
-            i = 0
-            for t in tags:
-                try:
-                    t.delete()
-                    i += 1
-                except Exception as e:
-                    logger.warn("Tag `%s' has not been deleted: %s",
-                                t.name, e)
-
-            if i == total:
-                logger.info('Done')
-            elif i == 0:
-                logger.error('Any tags deleted')
-            else:
-                logger.warn('%d/%d tags deleted', i, total)
-
-        if len(branches):
-            total = len(branches)
-            logger.info('%d branches to be deleted', total)
-            i = 0
-            for b in branches:
-                if b.name == self._item.default_branch:
-                    logger.warn("Skip the default branch `%s'", b.name)
-                    i += 1
-                    continue
-                try:
-                    b.delete()
-                    i += 1
-                except Exception as e:
-                    logger.warn("Branch `%s' has not been deleted: %s",
-                                b.name, e)
-
-            if i == total:
-                logger.info('Done')
-            elif i == 0:
-                logger.error('Any branches deleted')
+        groups = min(a2g.workers, len(self.FLUSH_GROUPS))
+        workers = max(a2g.workers // groups, 1)
+
+        def flushGroup(group):
+            return sum(self._flushKind(*kind, workers=workers)
+                       for kind in group)
+
+        found = sum(imap(flushGroup, self.FLUSH_GROUPS, groups))
+        if found == 0:
+            logger.info('Nothing to do')
+        return self
+
+    def _flushKind(self, kind, title, name, workers=1):
+        """
+        Delete every object of a kind, page by page, and log the throughput
+
+        Returns:
+            int: The number of objects found
+        """
+        import time
+        manager = getattr(self._item, kind)
+        listing = manager.list(iterator=True, per_page=self.FLUSH_PAGE)
+        total = getattr(listing, 'total', None)
+        start = time.time()
+
+        def delete(item):
+            if kind == 'branches' and \
+                    item.name == self._item.default_branch:
+                logger.warn("Skip the default branch `%s'", item.name)
+                return True
+            try:
+                item.delete()
+                return True
+            except Exception as e:
+                logger.warn("%s `%s' has not been deleted: %s",
+                            title, getattr(item, name), e)
+                return False
+
+        found = 0
+        deleted = 0
+        for page in self._pages(manager, listing, name):
+            if found == 0 and total is None:
+                logger.info('%s to be deleted', kind.capitalize())
+            elif found == 0:
+                logger.info('%d %s to be deleted', total, kind)
+            found += len(page)
+            deleted += sum(imap(delete, page, workers))
+
+        if found == 0:
+            return 0
+        elapsed = max(time.time() - start, 0.001)
+        if deleted == found:
+            logger.info('Done, %d %s deleted in %.1fs (%.1f/s)',
+                        deleted, kind, elapsed, deleted / elapsed)
+        elif deleted == 0:
+            logger.error('Any %s deleted', kind)
+        else:
+            logger.warn('%d/%d %s deleted', deleted, found, kind)
+        return found
+
+    def _pages(self, manager, listing, name):
+        """
+        Yield the objects to delete, one page at a time
+
+        Deleted objects leave the listing and shift the next pages, so the
+        same page is listed again until it only holds objects already tried
+        (they could not be deleted), then the next one.
+
+        Returns:
+            generator
+        """
+        import itertools
+        tried = set()
+        page = list(itertools.islice(listing, self.FLUSH_PAGE))
+        number = 1
+        while page:
+            fresh = [o for o in page if getattr(o, name) not in tried]
+            if fresh:
+                tried.update(getattr(o, name) for o in fresh)
+                yield fresh
+            elif len(page) < self.FLUSH_PAGE:
+                return
             else:
-                logger.warn('%d/%d branches deleted', i, total)
+                number += 1
+            page = manager.list(page=number, per_page=self.FLUSH_PAGE)
+
+    def recreate(self):
+        """
+        Delete the project and create it again, empty
+
+        Much faster than deleting every object, but only the owner of the
+        project can do it, and everything else in it is lost: the repository,
+        the wiki, the merge requests, the settings... The project is deleted
+        only if it can be created again in its namespace. If the instance
+        only marks it for deletion, it is removed at once, or restored.
+
+        Returns:
+            bool: Whether the project has been recreated
+        """
+        import time
+        if not self._canRecreate():
+            return False
+
+        attrs = {
+            'name': self._item.name,
+            'path': self._item.path,
+            'namespace_id': self._item.namespace['id'],
+            'visibility': self._item.visibility,
+            'description': self._item.description}
+        try:
+            self._item.delete()
+        except Exception as e:
+            logger.warn("Project `%s' has not been deleted: %s",
+                        self._repo, e)
+            return False
+        if not self._removeMarked():
+            return False
+
+        # The deletion is done in the background, the path is freed later
+        projects = managers.GitlabManager().gitlab.projects
+        attempts = 7
+        for attempt in range(attempts):
+            try:
+                self._item = projects.create(attrs)
+                logger.info("Project `%s' recreated", self._repo)
+                return True
+            except Exception as e:
+                if attempt + 1 == attempts:
+                    logger.error("Project `%s' deleted, but not created "
+                                 "again: %s", self._repo, e)
+                    raise
+                logger.debug("Project `%s' not created yet: %s",
+                             self._repo, e)
+                time.sleep(2 ** attempt)
+
+    def _canRecreate(self):
+        """
+        Tell whether the project can be deleted and created again
+
+        The owner of the project must be allowed to create a project in its
+        namespace: a maintainer of the group, or a user allowed to create
+        projects in their own namespace.
+
+        Returns:
+            bool
+        """
+        access = self._item.permissions or {}
+        levels = [(a or {}).get('access_level', 0) for a in access.values()]
+        if max(levels + [0]) < 50:
+            logger.warn("Not the owner of `%s', delete its objects instead",
+                        self._repo)
+            return False
+
+        if self._item.namespace.get('kind') == 'user':
+            gitlab = managers.GitlabManager().gitlab
+            gitlab.auth()
+            allowed = getattr(gitlab.user, 'can_create_project', False)
+        else:
+            group = access.get('group_access') or {}
+            allowed = group.get('access_level', 0) >= 40
+        if not allowed:
+            logger.warn("Not allowed to create `%s' again, delete its objects "
+                        "instead", self._repo)
+        return allowed
+
+    def _removeMarked(self):
+        """
+        Remove at once the project only marked for deletion, if any
+
+        With delayed deletion, the project is kept for days: it is removed
+        permanently, or restored if not allowed.
+
+        Returns:
+            bool: Whether the project is gone
+        """
+        projects = managers.GitlabManager().gitlab.projects
+        try:
+            marked = projects.get(self._item.id)
+        except Exception:
+            return True
+        if not (getattr(marked, 'marked_for_deletion_at', None) or
+                getattr(marked, 'marked_for_deletion_on', None)):
+            return True
+        try:
+            marked.delete(permanently_remove=True,
+                          full_path=marked.path_with_namespace)
+            return True
+        except Exception as e:
+            logger.warn("Project `%s' only marked for deletion (%s), restore "
+                        "it and delete its objects instead", self._repo, e)
+            marked.restore()
+            self._item = projects.get(self._item.id)
+            return False
 
 
 class Milestone(object):
+    _filled = None
     _item = None
+    kind = 'milestone'
 
-    def __init__(self, title, parent):
+    def __init__(self, title, parent, item=None):
         self.title = title
-        for m in parent.milestones.list(search=title):
-            if m.title == title:
-                self._item = m
-                break
+        self._item = item
         if not self._item:
-            self._item = parent.milestones.create({'title': title})
-            logger.debug("Milestone `%s' created", title)
+            index = managers.GitlabManager().milestoneIndex
+            self._item = index.get(title)
+            if not self._item:
+                self._item = parent.milestones.create({'title': title})
+                index[title] = self._item
+                logger.debug("Milestone `%s' created", title)
+        self._cache()
 
     def __getattr__(self, name):
         return getattr(self._item, name)
 
+    def _cache(self):
+        managers.GitlabManager().cache.set(self.kind, self.title, {
+            'id': self._item.id,
+            'title': self.title,
+            'state': self._item.state,
+            'due_date': self._item.due_date})
+
     def _fill(self, state, due_date=None):
+        # Many issues share the same sprint or version
+        if self._filled == (state, due_date):
+            return
+        self._filled = (state, due_date)
+
         toSave = False
         if state == 'closed' and self._item.state == 'active':
             self._item.state_event = 'close'
@@ -403,6 +1022,7 @@ class Milestone(object):
                 toSave = True
         if toSave:
             self._item.save()
+            self._cache()
             logger.debug("Milestone `{}' updated".format(self.title))
 
     def fillFromJiraSprint(self, sprint):
@@ -416,15 +1036,17 @@ class Milestone(object):
 
 
 class GroupMilestone(Milestone):
-    def __init__(self, title):
+    kind = 'group_milestone'
+
+    def __init__(self, title, item=None):
         parent = managers.GitlabManager().group
-        Milestone.__init__(self, title, parent)
+        Milestone.__init__(self, title, parent, item)
 
 
 class ProjectMilestone(Milestone):
-    def __init__(self, title):
+    def __init__(self, title, item=None):
         parent = managers.GitlabManager().project
-        Milestone.__init__(self, title, parent)
+        Milestone.__init__(self, title, parent, item)
 
 
 class User(object):
@@ -447,8 +1069,13 @@ class User(object):
             gitlab.v4.objects.User
         """
         if not self._item:
-            users = managers.GitlabManager().gitlab.users.list(
-                username=self.username)
+            manager = managers.GitlabManager()
+            if a2g.gitlab_prefetch_users:
+                index = manager.userIndex
+                users = [index[self.username]] \
+                    if self.username in index else []
+            else:
+                users = manager.gitlab.users.list(username=self.username)
             if len(users) == 1:
                 self._item = users[0]
             else:
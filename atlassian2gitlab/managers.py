@@ -2,6 +2,9 @@ import atlassian2gitlab as a2g
 from . import gl_resources as resources
 import logging
 from singleton_decorator import singleton
+from .concurrency import Locks, imap
+from .profiling import profiler
+from .progress import tracker
 
 
 logger = logging.getLogger('atlassian2gitlab')
@@ -9,13 +12,21 @@ logger = logging.getLogger('atlassian2gitlab')
 
 @singleton
 class GitlabManager(object):
+    _cache = None
     _client = None
     _group = None
     _project = None
     _attachments = {}
+    _boards = {}
+    _boardLists = None
     _labels = {}
+    _labelIndex = None
     _milestones = {}
+    _milestoneIndex = None
+    _uploader = None
     _users = {}
+    _userIndex = None
+    lock = Locks()
 
     @property
     def gitlab(self):
@@ -30,6 +41,28 @@ class GitlabManager(object):
             self._client = Gitlab()
         return self._client
 
+    @property
+    def cache(self):
+        """
+        Return the cache of Gitlab objects, persisted if configured
+
+        Returns:
+            atlassian2gitlab.cache.Cache
+        """
+        if not self._cache:
+            from atlassian2gitlab.cache import Cache
+            self._cache = Cache(a2g.cache_file, scope='{}/{}'.format(
+                (a2g.gitlab_url or '').rstrip('/'), a2g.gitlab_repo))
+        return self._cache
+
+    def restore(self, manager, attrs):
+        """
+        Rebuild a python-gitlab object from cached attributes
+
+        No request is sent, the object is built the same way as a listed one.
+        """
+        return manager._obj_cls(manager, attrs)
+
     @property
     def group(self):
         from atlassian2gitlab.exceptions import NotFoundException
@@ -55,6 +88,30 @@ class GitlabManager(object):
             self._project = resources.Project(a2g.gitlab_repo)
         return self._project
 
+    @property
+    def userIndex(self):
+        """
+        Return every Gitlab user, indexed by username and by email
+
+        The users directory is downloaded once, page by page. Emails are only
+        indexed if visible with the token used.
+
+        Returns:
+            dict
+        """
+        with self.lock('userIndex'):
+            if self._userIndex is None:
+                index = {}
+                for u in self.gitlab.users.list(all=True, per_page=100):
+                    index[u.username] = u
+                    email = getattr(u, 'email', None)
+                    if email:
+                        index.setdefault(email, u)
+                logger.debug('%d Gitlab users indexed', len(index))
+                self._userIndex = index
+        return self._userIndex
+
+    @profiler.timed('GitlabManager.findUser')
     def findUser(self, name):
         """
         Find Gitlab user
@@ -67,23 +124,43 @@ class GitlabManager(object):
         Returns:
             atlassian2gitlab.gl_resources.User
         """
-        if name not in self._users.keys():
-            from atlassian2gitlab.exceptions import NotFoundException
-            try:
-                username = a2g.user_map.get(name, name)
-                user = resources.User(username)
-                user.get()
-                self._users[name] = user
-            except NotFoundException:
-                username = a2g.user_map.get('_default', 'current')
-                logger.debug('Try the {} user instead'.format(username))
-                if username == 'current':
-                    self.gitlab.auth()
-                    username = self.gitlab.user.username
-                self._users[name] = resources.User(username)
+        with self.lock('user', name):
+            if name not in self._users.keys():
+                cached = self.cache.get('user', name)
+                if cached:
+                    user = resources.User(cached['username'])
+                    if 'id' in cached:
+                        user._item = self.restore(self.gitlab.users, cached)
+                    self._users[name] = user
+                else:
+                    self._users[name] = self._findUser(name)
         return self._users[name]
 
+    def _findUser(self, name):
+        from atlassian2gitlab.exceptions import NotFoundException
+        try:
+            username = a2g.user_map.get(name, name)
+            user = resources.User(username)
+            item = user.get()
+            self.cache.set('user', name, {
+                'id': item.id, 'username': username})
+        except NotFoundException:
+            username = a2g.user_map.get('_default', 'current')
+            logger.debug('Try the {} user instead'.format(username))
+            if username == 'current':
+                self.gitlab.auth()
+                username = self.gitlab.user.username
+            user = resources.User(username)
+            self.cache.set('user', name, {'username': username})
+        return user
+
     def findBoard(self, name=None):
+        with self.lock('board'):
+            if name not in self._boards.keys():
+                self._boards[name] = self._findBoard(name)
+        return self._boards[name]
+
+    def _findBoard(self, name=None):
         from atlassian2gitlab.exceptions import NotFoundException
         if name:
             try:
@@ -109,6 +186,40 @@ class GitlabManager(object):
         else:
             return boards[0]
 
+    @profiler.timed('GitlabManager.addBoardList')
+    def addBoardList(self, label):
+        """
+        Add a list for the label to the default board, if not already there
+
+        The lists of the board are fetched only once.
+        """
+        board = self.findBoard()
+        with self.lock('boardLists'):
+            if self._boardLists is None:
+                self._boardLists = set(
+                    l.label['name'] for l in board.lists.list(all=True))
+            if label.name not in self._boardLists:
+                board.lists.create({'label_id': label.id})
+                self._boardLists.add(label.name)
+                logger.debug("Add label `%s' to the board", label.name)
+
+    @property
+    def labelIndex(self):
+        """
+        Return the project labels indexed by name
+
+        Labels are listed once, then the index is kept up to date when
+        labels are created.
+
+        Returns:
+            dict
+        """
+        with self.lock('labelIndex'):
+            if self._labelIndex is None:
+                self._labelIndex = dict(
+                    (l.name, l) for l in self.project.labels.list(all=True))
+        return self._labelIndex
+
     def findLabel(self, name):
         """
         Return the expected project label
@@ -116,10 +227,34 @@ class GitlabManager(object):
         Returns:
             atlassian2gitlab.gl_resources.Label
         """
-        if name not in self._labels.keys():
-            self._labels[name] = resources.Label(name)
+        with self.lock('label', name):
+            if name not in self._labels.keys():
+                cached = self.cache.get('label', name)
+                item = None
+                if cached:
+                    item = self.restore(self.project.labels, cached)
+                self._labels[name] = resources.Label(name, item)
         return self._labels[name]
 
+    @property
+    def milestoneIndex(self):
+        """
+        Return the project milestones, or the group ones, indexed by title
+
+        Milestones are listed once, then the index is kept up to date when
+        milestones are created.
+
+        Returns:
+            dict
+        """
+        with self.lock('milestoneIndex'):
+            if self._milestoneIndex is None:
+                parent = self.group if a2g.gitlab_group_level \
+                    else self.project
+                self._milestoneIndex = dict(
+                    (m.title, m) for m in parent.milestones.list(all=True))
+        return self._milestoneIndex
+
     def findMilestone(self, title):
         """
         Return the expected project milestone
@@ -127,19 +262,60 @@ class GitlabManager(object):
         Returns:
             atlassian2gitlab.gl_resources.ProjectMilestone
         """
-        if title not in self._milestones.keys():
-            if a2g.gitlab_group_level:
-                self._milestones[title] = resources.GroupMilestone(title)
-            else:
-                self._milestones[title] = resources.ProjectMilestone(title)
+        with self.lock('milestone', title):
+            if title not in self._milestones.keys():
+                if a2g.gitlab_group_level:
+                    cls = resources.GroupMilestone
+                    parent = self.group
+                else:
+                    cls = resources.ProjectMilestone
+                    parent = self.project
+                cached = self.cache.get(cls.kind, title)
+                item = None
+                if cached:
+                    item = self.restore(parent.milestones, cached)
+                self._milestones[title] = cls(title, item)
         return self._milestones[title]
 
+    @property
+    def uploader(self):
+        """
+        Return the pool of threads transferring attachments
+
+        Returns:
+            concurrent.futures.ThreadPoolExecutor
+        """
+        with self.lock('uploader'):
+            if not self._uploader:
+                from concurrent.futures import ThreadPoolExecutor
+                self._uploader = ThreadPoolExecutor(
+                    max_workers=a2g.gitlab_uploads_in_flight)
+        return self._uploader
+
+    def stopUploader(self):
+        """
+        Wait for the transfers left, then stop the pool of threads
+        """
+        with self.lock('uploader'):
+            if self._uploader:
+                self._uploader.shutdown()
+                self._uploader = None
+
+    def prefetchAttachments(self, attachments):
+        """
+        Start transferring the Jira attachments in the background
+        """
+        for attachment in attachments:
+            self._transfer(attachment)
+
+    @profiler.timed('GitlabManager.attachFile')
     def attachFile(self, attachment):
         """
         Upload Jira attachment to the Gitlab project
 
         The filename is prepended by the Jira attachment ID because the same
-        name can be used in different Jira issues.
+        name can be used in different Jira issues. If the attachment has been
+        prefetched, we only wait for the end of its transfer.
 
         Returns:
             dict: A ``dict`` with the keys:
@@ -147,13 +323,111 @@ class GitlabManager(object):
                 * ``url`` - The direct url to the uploaded file
                 * ``markdown`` - Markdown for the uploaded file
         """
+        return self._transfer(attachment).result()
+
+    def _transfer(self, attachment):
+        """
+        Return the transfer of the attachment, started at first call
+
+        A failed transfer is forgotten, the next reference to the attachment
+        starts it again.
+
+        Returns:
+            concurrent.futures.Future
+        """
+        id = str(attachment.id)
+        with self.lock('attachments'):
+            future = self._attachments.get(id)
+            started = future is None
+            if started:
+                future = self.uploader.submit(self._attachFile, attachment)
+                self._attachments[id] = future
+        if started:
+            future.add_done_callback(
+                lambda f: f.exception() and self._forgetTransfer(id, f))
+        return future
+
+    def _forgetTransfer(self, id, future):
+        with self.lock('attachments'):
+            if self._attachments.get(id) is future:
+                del self._attachments[id]
+
+    def _attachFile(self, attachment):
         id = str(attachment.id)
-        if id not in self._attachments.keys():
-            a = self.project.upload(
-                filename='_'.join([attachment.id, attachment.filename]),
-                filedata=attachment.get())
-            self._attachments[id] = a
-        return self._attachments[id]
+        dedupe = a2g.gitlab_dedupe_attachments
+
+        a = self.cache.get('attachment', id)
+        if not a:
+            f, digest = self.download(attachment)
+            # Same content, and same name if asked: the name and size
+            # reported by Jira are not trusted alone
+            kind, key = ('upload_name', '{}:{}'.format(
+                attachment.filename, digest)) if dedupe == 'filename' \
+                else ('upload_hash', digest)
+            with f, self.lock('upload', digest):
+                if dedupe:
+                    a = self.cache.get(kind, key)
+                if not a:
+                    a = self.upload('_'.join([id, attachment.filename]), f)
+                    logger.debug("Attachment `%s' uploaded",
+                                 attachment.filename)
+                    if dedupe:
+                        self.cache.set(kind, key, a)
+                else:
+                    logger.debug("Attachment `%s' already uploaded",
+                                 attachment.filename)
+        self.cache.set('attachment', id, a)
+        return a
+
+    def upload(self, filename, f):
+        """
+        Upload the file to the project, retried while rate limited
+
+        The file is read again from the start for each attempt.
+
+        Returns:
+            dict: The ``alt``, ``url`` and ``markdown`` of the upload
+        """
+        import requests
+        import time
+        from .clients import backoff
+        retry = 0
+        while True:
+            f.seek(0)
+            try:
+                return self.gitlab.upload(self.project.id, filename, f)
+            except requests.HTTPError as e:
+                if e.response.status_code != 429 or \
+                        retry >= a2g.http_max_retries:
+                    raise
+                delay = backoff(retry, e.response)
+                logger.debug("Upload of `%s' rate limited, retried in %.1fs",
+                             filename, delay)
+                time.sleep(delay)
+                retry += 1
+
+    def download(self, attachment):
+        """
+        Download the Jira attachment in a temporary file
+
+        The content is streamed, only `attachment_buffer` bytes are kept in
+        memory, bigger files are written on disk. The content is hashed on
+        the fly.
+
+        Returns:
+            tuple: The ``tempfile.SpooledTemporaryFile`` and the SHA-256 of
+                its content
+        """
+        import hashlib
+        import tempfile
+        f = tempfile.SpooledTemporaryFile(max_size=a2g.attachment_buffer)
+        h = hashlib.sha256()
+        for chunk in attachment.iter_content(64 * 1024):
+            h.update(chunk)
+            f.write(chunk)
+            tracker.count('attachment_bytes', len(chunk))
+        f.seek(0)
+        return f, h.hexdigest()
 
 
 @singleton
@@ -212,6 +486,50 @@ class BitBucketManager(object):
         shutil.rmtree(tmpdir)
 
 
+class IssuePager(object):
+    """
+    Iterate over Jira search results, page by page
+
+    The first page is downloaded at once to know the total. While a page is
+    consumed, the next one is downloaded in the background, so no more than
+    two pages are held in memory whatever the size of the project.
+
+    >>> pages = [[1, 2], [3, 4], [5]]
+    >>> pager = IssuePager(lambda start, size: pages[start // size], 2)
+    >>> list(pager)
+    [1, 2, 3, 4, 5]
+    """
+    def __init__(self, search, size):
+        self._search = search
+        self._size = size
+        self._first = search(0, size)
+        self.total = getattr(self._first, 'total', None)
+        self._count = len(self._first)
+
+    def __len__(self):
+        return self._count if self.total is None else self.total
+
+    def __iter__(self):
+        from concurrent.futures import ThreadPoolExecutor
+        page = self._first if self._first is not None \
+            else self._search(0, self._size)
+        self._first = None
+        start = 0
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while len(page):
+                start += len(page)
+                following = None
+                complete = self.total is None or start < self.total
+                if len(page) == self._size and complete:
+                    following = executor.submit(
+                        self._search, start, self._size)
+                for issue in page:
+                    yield issue
+                if not following:
+                    break
+                page = following.result()
+
+
 @singleton
 class JiraManager(object):
     """
@@ -219,6 +537,9 @@ class JiraManager(object):
     """
     _fields = None
     _client = None
+    _boards = set()
+    _sprints = {}
+    lock = Locks()
 
     @property
     def jira(self):
@@ -232,7 +553,52 @@ class JiraManager(object):
             self._fields = self.jira.fields()
         return [f['id'] for f in self._fields if f['name'] == name][0]
 
-    def findIssues(self, jql):
+    @profiler.timed('JiraManager.findSprint')
+    def findSprint(self, id, board_id=None):
+        """
+        Return the Jira sprint, downloaded only once
+
+        If the board is known, all its sprints are downloaded at once on the
+        first miss.
+
+        Returns:
+            jira.resources.Sprint
+        """
+        id = int(id)
+        if id not in self._sprints.keys() and board_id:
+            self.loadBoardSprints(int(board_id))
+        with self.lock('sprint', id):
+            if id not in self._sprints.keys():
+                self._sprints[id] = self.jira.sprint(id)
+        return self._sprints[id]
+
+    def loadBoardSprints(self, board_id):
+        """
+        Put every sprint of the agile board in the sprints cache
+        """
+        with self.lock('board', board_id):
+            if board_id in self._boards:
+                return
+            self._boards.add(board_id)
+            try:
+                sprints = self.jira.sprints(board_id, maxResults=False)
+            except Exception as e:
+                logger.debug("Unable to list sprints of board %d: %s",
+                             board_id, e)
+                return
+            for sprint in sprints:
+                self._sprints.setdefault(int(sprint.id), sprint)
+            logger.debug("%d sprints found in board %d",
+                         len(sprints), board_id)
+
+    @profiler.timed('JiraManager.searchIssues')
+    def searchIssues(self, jql, startAt=0, maxResults=None):
+        """
+        Return one page of the issues matching the JQL query
+
+        Returns:
+            jira.client.ResultList
+        """
         fields = [
             'assignee', 'attachment', 'created', 'description', 'fixVersions',
             'labels', 'summary', 'reporter', 'comment', 'issuetype', 'status',
@@ -242,32 +608,174 @@ class JiraManager(object):
         return self.jira.search_issues(
             jql,
             fields=', '.join(fields),
-            maxResults=10000)
+            startAt=startAt,
+            maxResults=maxResults or a2g.jira_page_size)
 
-    def cp(self):
+    def sinceJql(self, jql, since):
+        """
+        Restrict the JQL query to the issues updated since the date
+
+        Jira reads the date in the time zone of the user.
+
+        >>> manager = JiraManager()
+        >>> manager.sinceJql('project = PRO ORDER BY key', '2018-01-02 10:30')
+        '(project = PRO) AND updated >= "2018/01/02 10:30" ORDER BY key'
+        >>> manager.sinceJql(None, '2018-01-02T10:30:45')
+        'updated >= "2018/01/02 10:30"'
+
+        Returns:
+            str
+        """
+        import re
+        from dateutil.parser import parse
+        condition = 'updated >= "{}"'.format(
+            parse(since).strftime('%Y/%m/%d %H:%M'))
+        m = re.match(r'(?is)^(.*?)\s*(\border\s+by\b.*)?$', jql or '')
+        query, order = m.group(1), m.group(2)
+        if query:
+            condition = '({}) AND {}'.format(query, condition)
+        return ' '.join(filter(None, (condition, order)))
+
+    def now(self):
+        """
+        Return the date of the Jira server, in the time zone of its user
+
+        The date of `--since` is read by Jira in the time zone of the user,
+        whatever the clock of the host running the migration.
+
+        Returns:
+            str
+        """
+        from dateutil import tz
+        from dateutil.parser import parse
+        now = parse(self.jira.server_info()['serverTime'])
+        zone = tz.gettz(self.jira.myself().get('timeZone') or '')
+        if zone:
+            now = now.astimezone(zone)
+        return now.replace(tzinfo=None).isoformat()
+
+    def findIssues(self, jql):
+        """
+        Stream the issues matching the JQL query
+
+        Returns:
+            atlassian2gitlab.managers.IssuePager
+        """
+        return IssuePager(
+            lambda startAt, size: self.searchIssues(jql, startAt, size),
+            a2g.jira_page_size)
+
+    def copyIssue(self, issue, payload=None):
+        """
+        Migrate one Jira issue, logging instead of raising on failure
+
+        With the pipeline, the issue is loaded from the future of its
+        payload.
+
+        Returns:
+            str: ``done``, ``skipped`` or ``failed``
+        """
+        if issue.fields.issuetype.name == a2g.jira_epic_type:
+            logger.warning("Skip issue %s: It's an Epic", issue.key)
+            return 'skipped'
+
+        try:
+            if payload:
+                GitlabManager().project.loadIssue(issue, payload.result())
+            else:
+                GitlabManager().project.addIssue(issue)
+            return 'done'
+        except Exception as e:
+            logger.warning('Skip issue %s: %s', issue.key, e)
+            return 'failed'
+
+    def export(self, path):
+        """
+        Export the issues matching the JQL query to an archive
+        """
+        from .archive import Archive
         issues = self.findIssues(a2g.jira_jql)
         total = len(issues)
+        logger.info('%d issues to export', total)
+        tracker.start(total, a2g.progress_interval)
+        exported = Archive(path).write(issues)
+        tracker.stop()
+        logger.info("%d issues exported to `%s'", exported, path)
+        if exported < total:
+            logger.warning('%d issues failed to be exported, run the export '
+                           'again', total - exported)
+        return self
+
+    def cp(self, issues=None):
+        """
+        Migrate the issues matching the JQL query, or the given ones
+
+        With `--since`, only the issues updated since the date, or since the
+        last run, are migrated. The start of the run, read from Jira, is kept
+        in the cache as the date of the next one, if no issue failed.
+        """
+        started = None
+        if issues is None:
+            jql = a2g.jira_jql
+            if a2g.since:
+                since = a2g.since
+                if since == 'last':
+                    since = GitlabManager().cache.get('sync', a2g.jira_jql)
+                    if not since:
+                        logger.info('No previous run, migrate every issue')
+                started = self.now()
+                if since:
+                    jql = self.sinceJql(jql, since)
+                    logger.info('Migrate the issues updated since %s', since)
+            issues = self.findIssues(jql)
+        total = len(issues)
 
         if total == 0:
             logger.info('Nothing to do')
+            self.synced(started)
             return self
         else:
             logger.info('%d issues to migrate', total)
 
+        if a2g.workers > 1:
+            # Shared objects are resolved before workers start to use them
+            gl_mgr = GitlabManager()
+            gl_mgr.cache
+            gl_mgr.project
+            if a2g.gitlab_group_level:
+                gl_mgr.group
+
+        from .clients import Gitlab
+        tracker.start(total, a2g.progress_interval)
+        tracker.extras['gitlab'] = lambda: Gitlab.limiter
+
+        if a2g.transform_processes > 0:
+            from .pipeline import stages
+            copies = imap(
+                lambda item: self.copyIssue(*item),
+                stages(issues, a2g.transform_processes), a2g.workers)
+        else:
+            copies = imap(self.copyIssue, issues, a2g.workers)
+
         i = 0
         skipped = 0
-        for issue in issues:
-            if issue.fields.issuetype.name == a2g.jira_epic_type:
-                logger.warning("Skip issue %s: It's an Epic", issue.key)
-                skipped += 1
-                continue
-
-            try:
-                gl_mgr = GitlabManager()
-                gl_mgr.project.addIssue(issue)
-                i += 1
-            except Exception as e:
-                logger.warning('Skip issue %s: %s', issue.key, e)
+        failed = 0
+        try:
+            for status in copies:
+                if status == 'done':
+                    i += 1
+                    tracker.count('issues')
+                elif status == 'skipped':
+                    skipped += 1
+                    tracker.count('skipped')
+                else:
+                    failed += 1
+                    tracker.count('failed')
+        finally:
+            GitlabManager().stopUploader()
+            tracker.stop()
+        if not failed:
+            self.synced(started)
 
         if i == (total + skipped):
             logger.info('All done')
@@ -279,3 +787,10 @@ class JiraManager(object):
                 i, total, skipped)
 
         return self
+
+    def synced(self, started):
+        """
+        Keep the start of the run in the cache, for the next `--since`
+        """
+        if started:
+            GitlabManager().cache.set('sync', a2g.jira_jql, started)
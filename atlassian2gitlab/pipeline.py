@@ -0,0 +1,218 @@
+"""
+Migrate the issues in three stages connected by bounded queues
+
+* extract: the Jira issues are read, and their sprint is looked up, in a
+  thread of the parent process
+* transform: each issue is turned into a plain data payload, with the
+  Markdown of its description and comments, in a pool of processes
+* load: the payloads are sent to Gitlab by the workers, users and
+  attachments are resolved there
+
+The conversion does not hold the GIL of the workers any more: issues are
+converted on every core while the previous ones are loaded.
+"""
+import collections
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from dateutil.parser import parse
+from munch import munchify
+import atlassian2gitlab as a2g
+from . import managers
+from .concurrency import processPool
+
+
+logger = logging.getLogger('atlassian2gitlab')
+
+_END = object()
+
+
+def extract(issue):
+    """
+    Return the data of the Jira issue needed by the transform stage
+
+    Everything needing Jira is read here: the sprint and the id of the
+    Story Points field.
+
+    Returns:
+        dict
+    """
+    from .gl_resources import Issue
+    jira_manager = managers.JiraManager()
+    sprint = Issue().getSprint(issue.fields)
+    spField = jira_manager.getFieldId('Story Points')
+    return {
+        'key': issue.key,
+        'permalink': issue.permalink(),
+        'fields': issue.raw['fields'],
+        'story_points': issue.raw['fields'].get(spField),
+        'sprint': {
+            'name': str(sprint),
+            'state': sprint.state,
+            'endDate': getattr(sprint, 'endDate', None),
+        } if sprint else None,
+    }
+
+
+def transform(record, settings=None):
+    """
+    Build the Gitlab payload of the issue, from plain data to plain data
+
+    Users and attachments are left as tokens, to be resolved by the load
+    stage. The settings of the parent process needed here are given along,
+    the worker processes are not configured.
+
+    >>> payload = transform({
+    ...     'key': 'PRO-1', 'permalink': 'http://jira/browse/PRO-1',
+    ...     'story_points': 5, 'sprint': None,
+    ...     'fields': {
+    ...         'summary': 'Fix', 'created': '2018-01-02T10:00:00.000+0000',
+    ...         'reporter': {'name': 'jdoe'}, 'assignee': None,
+    ...         'description': 'See [~jdoe]', 'labels': ['core'],
+    ...         'fixVersions': [], 'resolution': None,
+    ...         'issuetype': {'name': 'Bug', 'iconUrl': 'http://jira/bug'},
+    ...         'status': {'name': 'Open', 'statusCategory': {
+    ...             'key': 'new', 'colorName': 'blue-gray'}},
+    ...         'comment': {'comments': []}}})
+    >>> payload['description'] == 'See \\ue001user=jdoe\\ue001'
+    True
+    >>> payload['weight'], [label['name'] for label in payload['labels']]
+    (4, ['core', 'Bug'])
+
+    Returns:
+        dict
+    """
+    from .at_resources import AtlassianNotationConverter
+    from .gl_resources import Issue
+    for name, value in (settings or {}).items():
+        setattr(a2g, name, value)
+    fields = record['fields']
+    converter = AtlassianNotationConverter(deferred=True)
+    converter._attachments = munchify(fields.get('attachment') or [])
+
+    def toMarkdown(text):
+        return converter.toMarkdown(text) if text else text
+
+    def user(field):
+        return field['name'] if field else None
+
+    milestone = None
+    sprint = record['sprint']
+    if sprint:
+        milestone = {
+            'title': sprint['name'],
+            'state': 'closed' if sprint['state'] == 'CLOSED' else 'active',
+            'due_date': sprint['endDate']}
+    elif fields.get('fixVersions'):
+        version = fields['fixVersions'][-1]
+        milestone = {
+            'title': version['name'],
+            'state': 'closed' if version.get('released') else 'active',
+            'due_date': version.get('releaseDate')}
+
+    labels = [{'name': label} for label in fields.get('labels') or []]
+    labels.append({
+        'name': fields['issuetype']['name'],
+        'iconUrl': fields['issuetype']['iconUrl']})
+    category = fields['status']['statusCategory']
+    if not fields.get('resolution') and \
+            category['key'] not in ('new', 'done'):
+        labels.append({
+            'name': fields['status']['name'],
+            'colorname': category['colorName'].split('-')[0],
+            'board': True})
+
+    comments = (fields.get('comment') or {}).get('comments') or []
+    resolved = fields.get('resolution') and fields.get('resolutiondate')
+    return {
+        'key': record['key'],
+        'permalink': record['permalink'],
+        'title': fields['summary'],
+        'created_at': parse(fields['created']).isoformat(),
+        'reporter': user(fields.get('reporter')),
+        'assignee': user(fields.get('assignee')),
+        'description': toMarkdown(fields.get('description')),
+        'milestone': milestone,
+        'weight': Issue().getWeight(record['story_points'])
+        if record['story_points'] else 0,
+        'labels': labels,
+        'notes': [{
+            'id': comment['id'],
+            'author': comment['author']['key'],
+            'body': toMarkdown(comment['body']),
+            'created_at': parse(comment['created']).isoformat(),
+        } for comment in comments],
+        'closed_at': parse(resolved).isoformat() if resolved else None,
+    }
+
+
+def stages(issues, processes=1, backlog=None):
+    """
+    Extract and transform the issues, ahead of their load
+
+    No more than `backlog` issues (twice the number of processes by default)
+    are waiting between two stages, so a lazy iterable is never fully loaded
+    in memory. Issues are yielded in order, with the future of their payload.
+    An issue failing to be extracted gets a failed future, like one failing
+    to be transformed. If the issues themselves fail to be read, the error
+    is raised once the issues already read are yielded.
+
+    Returns:
+        generator: Tuples of the Jira issue and the future of its payload
+    """
+    backlog = backlog or processes * 2
+    extracted = queue.Queue(maxsize=backlog)
+    stop = threading.Event()
+
+    def run():
+        try:
+            for issue in issues:
+                try:
+                    item = (issue, extract(issue))
+                except Exception as e:
+                    item = (issue, e)
+                while not stop.is_set():
+                    try:
+                        extracted.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except Exception as e:
+            logger.error('Unable to read the issues: %s', e)
+            extracted.put(e)
+            return
+        extracted.put(_END)
+
+    settings = {'storyPoint_map': a2g.storyPoint_map}
+    executor = processPool(processes)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        transformed = collections.deque()
+        error = None
+        while True:
+            item = extracted.get()
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                error = item
+                break
+            issue, record = item
+            if isinstance(record, Exception):
+                future = Future()
+                future.set_exception(record)
+            else:
+                future = executor.submit(transform, record, settings)
+            transformed.append((issue, future))
+            if len(transformed) >= backlog:
+                yield transformed.popleft()
+        while transformed:
+            yield transformed.popleft()
+        if error:
+            raise error
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
@@ -0,0 +1,159 @@
+import collections
+import contextlib
+import functools
+import json
+import math
+import threading
+import time
+
+
+class Histogram(object):
+    """
+    Durations of a span, counted in power of two buckets of milliseconds
+
+    >>> h = Histogram()
+    >>> for seconds in (0.0005, 0.003, 0.003, 0.1):
+    ...     h.add(seconds)
+    >>> h.export()['buckets']
+    {'<=1ms': 1, '<=4ms': 2, '<=128ms': 1}
+    >>> h.export()['count'], h.export()['max']
+    (4, 0.1)
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = collections.Counter()
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        ms = seconds * 1000
+        self.buckets[2 ** math.ceil(math.log2(ms)) if ms > 1 else 1] += 1
+
+    def export(self):
+        """
+        Returns:
+            dict
+        """
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'buckets': {'<={}ms'.format(b): self.buckets[b]
+                        for b in sorted(self.buckets)},
+        }
+
+
+class Profiler(object):
+    """
+    Time the spans of the migration, when enabled
+
+    Spans are nested in each thread. The durations of each span are counted
+    in a histogram, and the time spent in each stack of spans, not in their
+    children, is summed up for flame graphs.
+
+    >>> profiler = Profiler()
+    >>> profiler.enabled = True
+    >>> with profiler.span('issue'):
+    ...     with profiler.span('HTTP POST'):
+    ...         pass
+    >>> sorted(profiler.export())
+    ['HTTP POST', 'issue']
+    >>> [line.rsplit(' ', 1)[0] for line in profiler.folded().splitlines()]
+    ['issue', 'issue;HTTP POST']
+    """
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.histograms = collections.defaultdict(Histogram)
+            self.stacks = collections.Counter()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Time the context, if enabled
+        """
+        if not self.enabled:
+            yield
+            return
+        stack = self._local.__dict__.setdefault('stack', [])
+        # Name and time spent in children
+        frame = [name, 0.0]
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            path = ';'.join(f[0] for f in stack)
+            stack.pop()
+            if stack:
+                stack[-1][1] += elapsed
+            with self._lock:
+                self.histograms[name].add(elapsed)
+                self.stacks[path] += max(elapsed - frame[1], 0)
+
+    def timed(self, name):
+        """
+        Decorate a function to time each of its calls as a span
+
+        Returns:
+            function
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.span(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def export(self):
+        """
+        Return the histogram of every span
+
+        Returns:
+            dict
+        """
+        with self._lock:
+            return {name: h.export()
+                    for name, h in sorted(self.histograms.items())}
+
+    def folded(self):
+        """
+        Return the time spent in each stack, in microseconds, in the folded
+        format of flame graph tools
+
+        Returns:
+            str
+        """
+        with self._lock:
+            return ''.join(
+                '{} {}\n'.format(path, int(seconds * 1000000))
+                for path, seconds in sorted(self.stacks.items()))
+
+    def dump(self, prefix):
+        """
+        Write the histograms in `<prefix>.json` and the stacks in
+        `<prefix>.folded`
+        """
+        with open(prefix + '.json', 'w') as f:
+            json.dump(self.export(), f, indent=2)
+        with open(prefix + '.folded', 'w') as f:
+            f.write(self.folded())
+
+
+profiler = Profiler()
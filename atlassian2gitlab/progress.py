@@ -0,0 +1,203 @@
+import collections
+import contextlib
+import logging
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger('atlassian2gitlab')
+
+
+class Progress(object):
+    """
+    Measure the progress of the migration, and report it periodically
+
+    Counters are added from any thread: migrated issues, notes, attachment
+    bytes... Extras are callables returning anything else to report. The
+    latency of the last API calls is kept to compute its percentiles, and
+    the workers in each phase of `Issue.fillFromJira` are counted, the
+    busiest phase is the bottleneck.
+
+    >>> progress = Progress()
+    >>> progress.start(4)
+    >>> progress.count('issues', 2)
+    >>> for ms in range(1, 101):
+    ...     progress.latency(ms / 1000)
+    >>> with progress.phase('notes'):
+    ...     progress.snapshot()['phases']
+    {'notes': 1}
+    >>> snapshot = progress.snapshot()
+    >>> snapshot['issues'], snapshot['total']
+    (2, 4)
+    >>> snapshot['p50'], snapshot['p90'], snapshot['p99']
+    (0.05, 0.09, 0.099)
+    """
+    LATENCIES = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.start(None)
+
+    def start(self, total, interval=None, stream=None):
+        """
+        Reset the counters, and report every `interval` seconds if any
+
+        On a TTY, the report is updated in place, otherwise it is logged.
+        """
+        self.stop()
+        with self._lock:
+            self.total = total
+            self.started = time.time()
+            self.counters = collections.Counter()
+            self.phases = collections.Counter()
+            self.latencies = collections.deque(maxlen=self.LATENCIES)
+            self.extras = {}
+        if interval:
+            self._stream = stream or sys.stderr
+            self._reported = False
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(interval,), daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop reporting, after a last report if any was done
+        """
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            if self._reported:
+                self.report()
+                if self._tty():
+                    self._stream.write('\n')
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def latency(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Count the workers in the phase while in the context
+        """
+        with self._lock:
+            self.phases[name] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] -= 1
+
+    def snapshot(self):
+        """
+        Return the counters, rates, latency percentiles and ETA
+
+        Returns:
+            dict
+        """
+        with self._lock:
+            elapsed = max(time.time() - self.started, 0.001)
+            counters = dict(self.counters)
+            phases = {k: v for k, v in self.phases.items() if v}
+            latencies = sorted(self.latencies)
+
+        done = sum(counters.get(k, 0)
+                   for k in ('issues', 'skipped', 'failed'))
+        rate = counters.get('issues', 0) / elapsed
+        snapshot = {
+            'issues': counters.get('issues', 0),
+            'skipped': counters.get('skipped', 0),
+            'failed': counters.get('failed', 0),
+            'total': self.total,
+            'elapsed': elapsed,
+            'issues_per_s': rate,
+            'notes_per_s': counters.get('notes', 0) / elapsed,
+            'attachments_mb_per_s':
+                counters.get('attachment_bytes', 0) / elapsed / 1024 ** 2,
+            'phases': phases,
+            'eta': None,
+        }
+        for name, p in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            snapshot[name] = latencies[int(len(latencies) * p) - 1] \
+                if latencies else None
+        if self.total and done:
+            snapshot['eta'] = (self.total - done) * elapsed / done
+        for name, extra in self.extras.items():
+            snapshot[name] = str(extra())
+        return snapshot
+
+    def format(self, snapshot):
+        """
+        Return the report to display on a terminal
+
+        Returns:
+            str
+        """
+        def ms(seconds):
+            return '-' if seconds is None else '%dms' % (seconds * 1000)
+
+        def duration(seconds):
+            if seconds is None:
+                return '-'
+            minutes, seconds = divmod(int(seconds), 60)
+            hours, minutes = divmod(minutes, 60)
+            days, hours = divmod(hours, 24)
+            return '{}{:02d}:{:02d}:{:02d}'.format(
+                '{}d '.format(days) if days else '', hours, minutes, seconds)
+
+        done = snapshot['issues'] + snapshot['skipped'] + snapshot['failed']
+        line = '{}/{} issues, {:.2f} issues/s, {:.2f} notes/s, ' \
+            '{:.2f} MB/s, API p50 {} p90 {} p99 {}, ETA {}'.format(
+                done, snapshot['total'] or '?',
+                snapshot['issues_per_s'], snapshot['notes_per_s'],
+                snapshot['attachments_mb_per_s'],
+                ms(snapshot['p50']), ms(snapshot['p90']),
+                ms(snapshot['p99']), duration(snapshot['eta']))
+        if snapshot['phases']:
+            line += ', in ' + ' '.join(
+                '{}:{}'.format(k, v)
+                for k, v in sorted(snapshot['phases'].items()))
+        for name in self.extras:
+            line += ', {} {}'.format(name, snapshot[name])
+        return line
+
+    def report(self):
+        """
+        Display the report in place on a TTY, log it otherwise
+        """
+        snapshot = self.snapshot()
+        if self._tty():
+            self._stream.write('\r\033[K' + self.format(snapshot))
+            self._stream.flush()
+            return
+        fields = []
+        for k, v in snapshot.items():
+            if isinstance(v, float):
+                v = '%.3f' % v
+            elif isinstance(v, dict):
+                v = ','.join('%s:%s' % i for i in sorted(v.items()))
+            elif isinstance(v, str) and ' ' in v:
+                v = '"%s"' % v
+            fields.append('{}={}'.format(k, '' if v is None else v))
+        logger.info('progress %s', ' '.join(fields))
+
+    def _tty(self):
+        stream = getattr(self, '_stream', None)
+        return bool(stream and hasattr(stream, 'isatty') and stream.isatty())
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self.report()
+            self._reported = True
+
+
+tracker = Progress()
@@ -0,0 +1,104 @@
+import json
+from munch import munchify
+from atlassian2gitlab.archive import Archive
+
+
+class fakeAttachment(object):
+    def __init__(self, content):
+        self.content = content
+
+    def iter_content(self, chunk_size):
+        yield self.content
+
+
+class fakeJiraIssue(object):
+    def __init__(self, key, attachments):
+        self.key = key
+        self.raw = {'key': key, 'fields': {
+            'summary': 'Title',
+            'status': {'name': 'To Do', 'statusCategory': {'key': 'new'}},
+            'issuetype': {'name': 'Story', 'iconUrl': 'http://icon'},
+            'attachment': [
+                {'id': n, 'filename': 'a.txt'}
+                for n, a in enumerate(attachments)]}}
+        self.fields = munchify(self.raw['fields'])
+        self.fields.attachment = attachments
+
+    def permalink(self):
+        return 'http://jira/browse/' + self.key
+
+
+def fakeManagers(mocker):
+    jira = mocker.patch('atlassian2gitlab.managers.JiraManager').return_value
+    jira._fields = [{'id': 'customfield_1', 'name': 'Sprint'}]
+    jira._sprints = {}
+    gitlab = mocker.patch(
+        'atlassian2gitlab.managers.GitlabManager').return_value
+    gitlab.cache.get.return_value = None
+    return jira, gitlab
+
+
+def test_export_and_read_archive(mocker, tmpdir):
+    jira, gitlab = fakeManagers(mocker)
+    mocker.patch(
+        'atlassian2gitlab.gl_resources.Issue.getSprint',
+        side_effect=[munchify({'id': 7, 'raw': {'id': 7, 'name': 'S1'}}),
+                     None])
+    get = mocker.patch('requests.Session.get')
+    get.return_value.iter_content.return_value = [b'<svg/>']
+    get.return_value.headers = {'Content-Type': 'image/svg+xml'}
+    color = mocker.patch(
+        'atlassian2gitlab.gl_resources.Issue.getDominantColor',
+        return_value='#ffffff')
+    archive = Archive(str(tmpdir))
+    issues = [
+        fakeJiraIssue('PRO-1', [fakeAttachment(b'Same')]),
+        fakeJiraIssue('PRO-2', [fakeAttachment(b'Same')])]
+
+    assert archive.write(issues) == 2
+    assert get.call_count == 1
+    # Attachments and icon stored once by content
+    assert len(tmpdir.join('blobs').listdir()) == 2
+
+    jira._sprints = {}
+    issues = archive.read()
+    assert len(issues) == 2
+    issues = list(issues)
+    assert [i.key for i in issues] == ['PRO-1', 'PRO-2']
+    assert issues[0].permalink() == 'http://jira/browse/PRO-1'
+    assert issues[0].fields.status.raw['statusCategory']['key'] == 'new'
+    attachment = issues[1].fields.attachment[0]
+    assert attachment.filename == 'a.txt'
+    assert b''.join(attachment.iter_content(2)) == b'Same'
+    assert jira._fields == [{'id': 'customfield_1', 'name': 'Sprint'}]
+    assert str(jira._sprints[7]) == 'S1'
+    assert color.call_args[0][1] is True
+    gitlab.cache.set.assert_called_once_with('color', 'http://icon', '#ffffff')
+
+
+def test_failed_issue_is_skipped_and_downloads_are_reused(mocker, tmpdir):
+    fakeManagers(mocker)
+    mocker.patch('atlassian2gitlab.gl_resources.Issue.getSprint',
+                 return_value=None)
+    get = mocker.patch('requests.Session.get')
+    get.return_value.iter_content.return_value = [b'<svg/>']
+    get.return_value.headers = {'Content-Type': 'image/svg+xml'}
+    mocker.patch('atlassian2gitlab.gl_resources.Issue.getDominantColor',
+                 return_value='#ffffff')
+    broken = mocker.MagicMock()
+    broken.iter_content.side_effect = Exception('Connection reset')
+    archive = Archive(str(tmpdir))
+    failing = fakeJiraIssue('PRO-2', [broken])
+    failing.raw['fields']['attachment'][0]['id'] = 1
+
+    assert archive.write([
+        fakeJiraIssue('PRO-1', [fakeAttachment(b'Data')]), failing]) == 1
+    manifest = json.loads(tmpdir.join('manifest.json').read())
+    assert manifest['failed'] == [
+        {'key': 'PRO-2', 'error': 'Connection reset'}]
+
+    again = mocker.MagicMock()
+    assert archive.write([fakeJiraIssue('PRO-1', [again])]) == 1
+    assert again.iter_content.call_count == 0
+    assert get.call_count == 1
+    assert [i.key for i in archive.read()] == ['PRO-1']
@@ -1,3 +1,4 @@
+import atlassian2gitlab as a2g
 from atlassian2gitlab.at_resources import JiraNotationConverter
 from munch import munchify
 import re
@@ -33,3 +34,64 @@ def test_attachments_to_markdown(mocker):
 
     assert converter.toMarkdown('!blah.jpg!') == expected
     assert converter.toMarkdown('!blah.jpg|thumbnail!') == expected
+
+
+def test_emoticons_are_converted_once(mocker):
+    mocker.patch('atlassian2gitlab.managers.GitlabManager')
+    converter = JiraNotationConverter(munchify({'fields': {'attachment': []}}))
+
+    assert converter.toMarkdown(':)(y) (*r)') == \
+        ':smiley::thumbsup: :star:'
+
+
+def test_table_headings_are_converted_separately(mocker):
+    mocker.patch('atlassian2gitlab.managers.GitlabManager')
+    converter = JiraNotationConverter(munchify({'fields': {'attachment': []}}))
+
+    given = '||a||b||\n|1|2|\n\ntext\n\n||c||\n|3|'
+    expected = '|a|b|\n|-|-|\n|1|2|\n\ntext\n\n|c|\n|-|\n|3|'
+    assert converter.toMarkdown(given) == expected
+
+
+def test_kept_parts_are_forgotten_between_conversions(mocker):
+    mocker.patch('atlassian2gitlab.managers.GitlabManager')
+    converter = JiraNotationConverter(munchify({'fields': {'attachment': []}}))
+
+    converter.toMarkdown('[a|http://a] [b|http://b] {{%1%}}')
+    assert converter.toMarkdown('[c|http://c] %1%') == \
+        '[c](http://c) %1%'
+    assert len(converter._forLater) == 1
+
+
+def test_nested_kept_parts_are_restored(mocker):
+    mocker.patch('atlassian2gitlab.managers.GitlabManager')
+    converter = JiraNotationConverter(munchify({'fields': {'attachment': []}}))
+
+    given = '[see {code}a\\d{code}|http://x]'
+    assert converter.toMarkdown(given) == \
+        '[see \n```\na\\d\n```](http://x)'
+
+
+def test_many_texts_converted_in_processes(mocker, datadir):
+    mocker.patch.object(a2g, 'markdown_processes', 2)
+    mock = mocker.patch('atlassian2gitlab.managers.GitlabManager')
+    manager = mock.return_value
+    manager.findUser.return_value = munchify({'username': 'gwerlas'})
+    manager.attachFile.return_value = {'markdown': '[alt](blah.jpg)'}
+    given = datadir['given.txt'].read_text('utf-8')
+    expected = datadir['expected.txt'].read_text('utf-8')
+    converter = JiraNotationConverter(
+        munchify({'fields': {'attachment': [{'filename': 'blah.jpg'}]}}))
+
+    texts = [given, '!blah.jpg! by [~jdoe]'] * 3
+    converted = converter.convertMany(texts)
+
+    assert len(converted) == 6
+    assert converted[1] == '\ue001attachment=blah.jpg\ue001 by ' \
+        '\ue001user=jdoe\ue001'
+    assert not manager.attachFile.called
+
+    converter.prepare(texts)
+    assert converter.toMarkdown(given) == expected
+    assert converter.toMarkdown('!blah.jpg! by [~jdoe]') == \
+        '[alt](blah.jpg) by @gwerlas'
@@ -18,10 +18,15 @@ def test_config(mocker):
 
     ap.parse_args.return_value = munchify({
         'config': 'my-config.ini',
-        'flush': False})
+        'flush': False,
+        'resume': False,
+        'since': None,
+        'workers': 1,
+        'export_path': None,
+        'import_path': None})
 
     cli.configure('This is my test !')
 
-    assert ap.add_argument.call_count == 3
+    assert ap.add_argument.call_count == 8
     assert ap.parse_args.call_count == 1
     cp.read.assert_called_once_with('my-config.ini')
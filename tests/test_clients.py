@@ -5,7 +5,95 @@ def test_gitlab_client():
     assert a2g.clients.Gitlab().api_version == '4'
 
 
+def test_gitlab_client_leaves_retries_to_the_transport(mocker):
+    request = mocker.patch('gitlab.Gitlab.http_request')
+    a2g.gitlab_url = 'http://my-gitlab.local'
+
+    a2g.clients.Gitlab().http_request('get', '/projects')
+
+    request.assert_called_once_with(
+        'get', '/projects', obey_rate_limit=False,
+        retry_transient_errors=False)
+
+
 def test_jira_client(mocker):
     mock = mocker.patch('jira.JIRA')
     a2g.clients.Jira().blah
     assert mock.call_count == 1
+
+
+def test_gitlab_streaming_upload(mocker):
+    import io
+    a2g.gitlab_url = 'http://my-gitlab.local'
+    post = mocker.patch('atlassian2gitlab.clients.upload_session.post')
+    post.return_value.json.return_value = {'markdown': 'blah'}
+
+    upload = a2g.clients.Gitlab().upload(42, 'a.txt', io.BytesIO(b'Data'))
+
+    assert upload == {'markdown': 'blah'}
+    url = post.call_args[0][0]
+    assert url == 'http://my-gitlab.local/api/v4/projects/42/uploads'
+    encoder = post.call_args[1]['data']
+    assert b'Data' in encoder.to_string()
+    assert post.call_args[1]['timeout'] == a2g.clients.TIMEOUT
+
+
+def test_bitbucket_client_uses_pooled_session(mocker):
+    a2g.bitbucket_url = 'https://bitbucket.org'
+    client = a2g.clients.BitBucket()
+    get = mocker.patch.object(client.session, 'get')
+    get.return_value.json.return_value = {'name': 'repo'}
+
+    assert client.get('/repositories/project/repo').name == 'repo'
+    adapter = client.session.get_adapter(client.api_url)
+    assert isinstance(adapter.max_retries, a2g.clients.Retry)
+
+
+def test_jira_client_retries_in_transport(mocker):
+    mock = mocker.patch('jira.JIRA')
+    a2g.clients.Jira().blah
+    assert mock.call_args[1]['max_retries'] == 0
+    assert mock.return_value._session.mount.call_count == 2
+
+
+def test_retry_backoff_has_jitter():
+    from urllib3.exceptions import ResponseError
+    retry = a2g.clients.Retry(total=5, backoff_factor=1)
+    for _ in range(3):
+        retry = retry.increment('GET', '/', error=ResponseError())
+    for _ in range(10):
+        assert 2 <= retry.get_backoff_time() <= 6
+
+
+def test_throttled_adapter_follows_rate_limit(mocker):
+    import time
+    from munch import munchify
+    limiter = a2g.clients.RateLimiter(concurrency=4)
+    adapter = a2g.clients.ThrottledAdapter(limiter)
+    response = munchify({
+        'status_code': 201,
+        'headers': {
+            'RateLimit-Remaining': '60',
+            'RateLimit-Reset': str(time.time() + 60)}})
+    mocker.patch('requests.adapters.HTTPAdapter.send', return_value=response)
+
+    assert adapter.send(mocker.MagicMock()) is response
+    assert limiter.inFlight == 0
+    assert round(limiter.rate) == 1
+
+
+def test_retry_releases_the_slot_while_waiting(mocker):
+    from munch import munchify
+    limiter = a2g.clients.RateLimiter(concurrency=4)
+    retry = a2g.clients.Retry(total=3, limiter=limiter).new(total=2)
+    response = munchify({'status': 429, 'headers': {'Retry-After': '0'}})
+    limiter.acquire()
+
+    def sleep(response):
+        assert limiter.inFlight == 0
+    mocker.patch('urllib3.util.retry.Retry.sleep', side_effect=sleep)
+    retry.sleep(response)
+
+    assert retry.limiter is limiter
+    assert limiter.inFlight == 1
+    assert limiter.limit == 2
@@ -1,8 +1,8 @@
 import pytest
 from munch import munchify
 import atlassian2gitlab as a2g
+from atlassian2gitlab.exceptions import A2GException
 from atlassian2gitlab.gl_resources import Issue, Label
-from gitlab.exceptions import GitlabGetError
 
 
 def fakeGitlabManager(mocker):
@@ -11,6 +11,7 @@ def fakeGitlabManager(mocker):
     mgr.project = mocker.MagicMock()
     mgr.project.issues = mocker.MagicMock()
     mgr.project.labels = mocker.MagicMock()
+    mgr.labelIndex = {}
     mgr.findUser.return_value = fakeUser()
     return mgr
 
@@ -60,13 +61,12 @@ def test_todo_issue_in_sprint(mocker):
     a2g.jira_link_to_source = False
 
     jira_manager = fakeJiraManager(mocker)
-    jira_manager.jira.sprint.return_value = 'Sprint 1'
+    jira_manager.findSprint.return_value = 'Sprint 1'
 
     jira_issue = fakeJiraIssue()
-    jira_issue.fields.customfield_10001 = ['id=20,']
+    jira_issue.fields.customfield_10001 = ['rapidViewId=3,id=20,']
 
     gl_manager = fakeGitlabManager(mocker)
-    gl_manager.project.labels.get.side_effect = GitlabGetError
     gl_label = Label('Story')
     gl_label.color = None
     gl_manager.findLabel.return_value = gl_label
@@ -91,6 +91,7 @@ def test_todo_issue_in_sprint(mocker):
     gl_manager.project.labels.create.assert_called_once_with({
         'name': 'Story',
         'color': '#cccccc'})
+    jira_manager.findSprint.assert_called_once_with('20', '3')
 
 
 def test_in_progress_issue_with_version(mocker):
@@ -105,7 +106,6 @@ def test_in_progress_issue_with_version(mocker):
     jira_issue.fields.status.raw.statusCategory.color = 'yellow'
 
     gl_manager = fakeGitlabManager(mocker)
-    gl_manager.project.labels.get.side_effect = GitlabGetError
     story_label = Label('Story')
     story_label.color = '#cccccc'
     wip_label = Label('In Progress')
@@ -138,6 +138,7 @@ def test_resolved_issue_with_comments(mocker):
 
     jira_issue = fakeJiraIssue()
     jira_issue.fields.comment = munchify({'comments': [{
+        'id': '10000',
         'body': 'Content',
         'created': '12/Apr/2008 9 PM',
         'author': {'key': 'jdoe'}}]})
@@ -172,3 +173,303 @@ def test_resolved_issue_with_comments(mocker):
     assert gl_issue.state_event == 'close'
     assert gl_issue.updated_at == '2012-12-12T12:12:00'
     assert gl_issue.save.call_count == 1
+
+
+def test_resume_half_done_issue(mocker):
+    a2g.jira_link_to_source = True
+    a2g.resume = True
+
+    fakeJiraManager(mocker)
+
+    jira_issue = fakeJiraIssue()
+    jira_issue.fields.comment = munchify({'comments': [{
+        'id': '10000',
+        'body': 'Already there',
+        'created': '12/Apr/2008 9 PM',
+        'author': {'key': 'jdoe'}}, {
+        'id': '10001',
+        'body': 'Missing',
+        'created': '12/Apr/2008 10 PM',
+        'author': {'key': 'jdoe'}}]})
+
+    gl_manager = fakeGitlabManager(mocker)
+    gl_manager.cache.get.return_value = {
+        'iid': 42, 'phases': ['issue'], 'notes': ['10000']}
+    gl_issue = mocker.MagicMock()
+    gl_manager.project.issues.get.return_value = gl_issue
+
+    Issue().fillFromJira(jira_issue)
+    a2g.resume = False
+
+    gl_manager.cache.get.assert_called_once_with('journal', 'PRO-1')
+    gl_manager.project.issues.get.assert_called_once_with(42)
+    assert gl_manager.project.issues.create.call_count == 0
+    gl_issue.notes.create.assert_has_calls([
+        mocker.call(
+            {'body': 'Missing', 'created_at': '2008-04-12T22:00:00'},
+            sudo='jdoe'),
+        mocker.call({'body': 'Imported from [PRO-1](http://url/)'})])
+    assert gl_issue.notes.create.call_count == 2
+    gl_manager.cache.set.assert_called_with('journal', 'PRO-1', {
+        'iid': 42, 'phases': ['issue', 'notes', 'link'],
+        'notes': ['10000', '10001']})
+
+
+def test_dominant_color_is_cached(mocker, tmpdir):
+    from atlassian2gitlab.cache import Cache
+    gl_manager = fakeGitlabManager(mocker)
+    gl_manager.cache = Cache()
+
+    def urlretrieve(url):
+        icon = tmpdir.join(url.split('/')[-1])
+        icon.write('same content')
+        headers = mocker.MagicMock()
+        headers.get_content_type.return_value = 'image/png'
+        return str(icon), headers
+    download = mocker.patch(
+        'urllib.request.urlretrieve', side_effect=urlretrieve)
+    colorthief = mocker.patch('colorthief.ColorThief')
+    colorthief.return_value.get_color.return_value = (204, 204, 204)
+
+    issue = Issue()
+    assert issue.getDominantColorFromUrl('http://url/story') == '#cccccc'
+    assert issue.getDominantColorFromUrl('http://url/story') == '#cccccc'
+    assert issue.getDominantColorFromUrl('http://url/task') == '#cccccc'
+
+    assert download.call_count == 2
+    assert colorthief.call_count == 1
+
+
+def test_failed_comment_does_not_abort_the_others(mocker):
+    a2g.jira_link_to_source = False
+
+    fakeJiraManager(mocker)
+
+    jira_issue = fakeJiraIssue()
+    jira_issue.fields.comment = munchify({'comments': [{
+        'id': str(10000 + n),
+        'body': 'Comment {}'.format(n),
+        'created': '12/Apr/2008 9 PM',
+        'author': {'key': 'jdoe'}} for n in range(3)]})
+
+    gl_manager = fakeGitlabManager(mocker)
+    gl_milestone = mocker.MagicMock()
+    gl_manager.findMilestone.return_value = gl_milestone
+    gl_issue = mocker.MagicMock()
+    gl_manager.project.issues.create.return_value = gl_issue
+    gl_issue.notes.create.side_effect = [None, Exception('502'), None]
+
+    issue = Issue()
+    with pytest.raises(A2GException, match='1 comments not created'):
+        issue.fillFromJira(jira_issue)
+
+    assert [c[0][0]['body'] for c in gl_issue.notes.create.call_args_list] \
+        == ['Comment 0', 'Comment 1', 'Comment 2']
+    assert not issue.isDone('notes')
+    assert issue._journal['notes'] == ['10000', '10002']
+
+
+def test_failed_comment_is_sent_again_if_safe(mocker):
+    from gitlab.exceptions import GitlabCreateError
+    from requests.exceptions import ConnectTimeout
+    mocker.patch('time.sleep')
+    gl_issue = mocker.MagicMock()
+    gl_issue.notes.create.side_effect = [
+        ConnectTimeout(), GitlabCreateError('Bad gateway', 502), None]
+    gl_issue.notes.list.return_value = [munchify({
+        'body': 'Other', 'created_at': '2008-04-12T21:00:00.000Z'})]
+    issue = Issue()
+    issue._item = gl_issue
+
+    note = issue.addNote((0, 'jdoe', {
+        'body': 'Content', 'created_at': '2008-04-12T23:00:00+02:00'}))
+
+    assert note == (0, 'jdoe', True)
+    assert gl_issue.notes.create.call_count == 3
+
+
+def test_failed_comment_created_anyway_is_not_sent_again(mocker):
+    from gitlab.exceptions import GitlabCreateError
+    mocker.patch('time.sleep')
+    gl_issue = mocker.MagicMock()
+    gl_issue.notes.create.side_effect = GitlabCreateError('Timeout', 504)
+    gl_issue.notes.list.return_value = [munchify({
+        'body': 'Content', 'created_at': '2008-04-12T21:00:00.000Z'})]
+    issue = Issue()
+    issue._item = gl_issue
+
+    note = issue.addNote((0, 'jdoe', {
+        'body': 'Content', 'created_at': '2008-04-12T23:00:00+02:00'}))
+
+    assert note == (0, 'jdoe', True)
+    assert gl_issue.notes.create.call_count == 1
+
+
+def test_rejected_comment_is_not_sent_again(mocker):
+    from gitlab.exceptions import GitlabCreateError
+    gl_issue = mocker.MagicMock()
+    gl_issue.notes.create.side_effect = GitlabCreateError('Bad request', 400)
+    issue = Issue()
+    issue._item = gl_issue
+
+    assert issue.addNote((0, 'jdoe', {'body': 'Content'})) == \
+        (0, 'jdoe', False)
+    assert gl_issue.notes.create.call_count == 1
+
+
+def test_update_migrated_issue_since_last_run(mocker):
+    a2g.jira_link_to_source = True
+    mocker.patch.object(a2g, 'since', 'last')
+
+    fakeJiraManager(mocker)
+
+    jira_issue = fakeJiraIssue()
+    jira_issue.fields.summary = 'New title'
+    jira_issue.fields.labels = ['backend']
+    jira_issue.fields.status.name = 'In Progress'
+    jira_issue.fields.status.raw.statusCategory.key = 'indeterminate'
+    # The first comment migrated is deleted in Jira since
+    jira_issue.fields.comment = munchify({'comments': [{
+        'id': '10001',
+        'body': 'Already there',
+        'created': '12/Apr/2008 9 PM',
+        'author': {'key': 'jdoe'}}, {
+        'id': '10002',
+        'body': 'New',
+        'created': '12/Apr/2008 10 PM',
+        'author': {'key': 'jdoe'}}]})
+
+    gl_manager = fakeGitlabManager(mocker)
+
+    def findLabel(name):
+        label = Label(name)
+        label.color = '#cccccc'
+        return label
+    gl_manager.findLabel.side_effect = findLabel
+    gl_manager.cache.get.return_value = {
+        'iid': 42, 'phases': ['issue', 'notes', 'link', 'close'],
+        'notes': ['10000', '10001']}
+    gl_issue = mocker.MagicMock(
+        iid=42, state='closed', title='Title', description='Big content',
+        assignees=[{'id': 1}], milestone=None, weight=4, labels=['Story'])
+    gl_manager.project.issues.get.return_value = gl_issue
+
+    issue = Issue()
+    issue.fillFromJira(jira_issue)
+
+    assert gl_manager.project.issues.create.call_count == 0
+    gl_manager.project.issues.update.assert_called_once_with(42, {
+        'title': 'New title',
+        'labels': ['backend', 'Story', 'In Progress']})
+    gl_manager.addBoardList.assert_called_once()
+    gl_issue.notes.create.assert_called_once_with(
+        {'body': 'New', 'created_at': '2008-04-12T22:00:00'}, sudo='jdoe')
+    assert gl_issue.state_event == 'reopen'
+    assert gl_issue.save.call_count == 1
+    gl_manager.cache.set.assert_called_with('journal', 'PRO-1', {
+        'iid': 42, 'phases': ['issue', 'notes', 'link'],
+        'notes': ['10000', '10001', '10002']})
+
+
+def test_issue_of_previous_run_is_updated(mocker):
+    a2g.jira_link_to_source = True
+
+    fakeJiraManager(mocker)
+
+    jira_issue = fakeJiraIssue()
+    jira_issue.fields.summary = 'New title'
+
+    gl_manager = fakeGitlabManager(mocker)
+    gl_manager.findLabel.return_value = Label('Story')
+    gl_manager.findLabel.return_value.color = '#cccccc'
+    gl_manager.cache.get.return_value = {
+        'iid': 42, 'phases': ['issue', 'notes', 'link'], 'notes': []}
+    gl_issue = munchify({
+        'iid': 42, 'title': 'Title', 'description': 'Big content',
+        'assignees': [{'id': 1}], 'milestone': None, 'weight': 4,
+        'labels': ['Story']})
+    gl_manager.project.issues.get.return_value = gl_issue
+
+    Issue().fillFromJira(jira_issue)
+
+    gl_manager.project.issues.get.assert_called_once_with(42)
+    assert gl_manager.project.issues.create.call_count == 0
+    gl_manager.project.issues.update.assert_called_once_with(
+        42, {'title': 'New title'})
+    gl_manager.cache.set.assert_called_with('journal', 'PRO-1', {
+        'iid': 42, 'phases': ['issue', 'notes', 'link'], 'notes': []})
+
+
+def test_issue_found_by_link_to_source(mocker):
+    a2g.jira_link_to_source = True
+    mocker.patch.object(a2g, 'resume', True)
+
+    fakeJiraManager(mocker)
+
+    jira_issue = fakeJiraIssue()
+    jira_issue.key = 'PRO-1'
+
+    gl_manager = fakeGitlabManager(mocker)
+    gl_manager.findLabel.return_value = Label('Story')
+    gl_manager.findLabel.return_value.color = '#cccccc'
+    gl_manager.cache.get.return_value = None
+    gl_manager.project.search.return_value = [{
+        'noteable_type': 'Issue', 'noteable_iid': 10,
+        'body': 'Imported from [PRO-10](http://url/)'}, {
+        'noteable_type': 'Issue', 'noteable_iid': 1,
+        'body': 'Imported from [PRO-1](http://url/)'}]
+    gl_issue = mocker.MagicMock(
+        iid=1, title='Title', description='Big content',
+        assignees=[], milestone=None, weight=4, labels=['Story'])
+    gl_manager.project.issues.get.return_value = gl_issue
+
+    Issue().fillFromJira(jira_issue)
+
+    gl_manager.project.search.assert_called_once_with(
+        'notes', 'Imported from [PRO-1](', iterator=True, per_page=100)
+    gl_manager.project.issues.get.assert_called_once_with(1)
+    gl_manager.project.issues.update.assert_called_once_with(
+        1, {'assignee_ids': [1]})
+    assert gl_issue.notes.create.call_count == 0
+
+
+def test_link_to_source_searched_only_when_resuming(mocker):
+    a2g.jira_link_to_source = True
+    mocker.patch.object(a2g, 'resume', False)
+    mocker.patch.object(a2g, 'since', None)
+
+    fakeJiraManager(mocker)
+
+    gl_manager = fakeGitlabManager(mocker)
+    gl_manager.findLabel.return_value = Label('Story')
+    gl_manager.findLabel.return_value.color = '#cccccc'
+    gl_manager.cache.get.return_value = None
+
+    Issue().fillFromJira(fakeJiraIssue())
+
+    assert not gl_manager.project.search.called
+    assert gl_manager.project.issues.create.called
+
+
+def test_issue_not_created_is_not_filled(mocker):
+    a2g.jira_link_to_source = True
+
+    fakeJiraManager(mocker)
+
+    jira_issue = fakeJiraIssue()
+    jira_issue.fields.comment = munchify({'comments': [{
+        'id': '10000',
+        'body': 'Content',
+        'created': '12/Apr/2008 9 PM',
+        'author': {'key': 'jdoe'}}]})
+
+    gl_manager = fakeGitlabManager(mocker)
+    gl_manager.findLabel.return_value = Label('Story')
+    gl_manager.findLabel.return_value.color = '#cccccc'
+    gl_manager.cache.get.return_value = None
+    gl_manager.project.issues.create.side_effect = Exception('500')
+
+    with pytest.raises(Exception):
+        Issue().fillFromJira(jira_issue)
+
+    assert gl_manager.project.issues.create.call_count == 1
@@ -1,3 +1,5 @@
+import hashlib
+import pytest
 import atlassian2gitlab as a2g
 from atlassian2gitlab.managers import GitlabManager
 from munch import munchify
@@ -30,36 +32,251 @@ def test_find_user(mocker):
     manager._client = gl
 
     gl.users = mocker.MagicMock()
-    gl.users.list.return_value = ['me']
+    gl.users.list.return_value = [munchify({'id': 2, 'username': 'me'})]
 
     user = manager.findUser('me')
     assert user.username == 'me'
+    assert manager.cache.get('user', 'me') == {'id': 2, 'username': 'me'}
+
+
+def test_find_user_from_cache(mocker):
+    manager = GitlabManager()
+    gl = mocker.MagicMock()
+    manager._client = gl
+    manager.cache.set('user', 'cached', {'id': 3, 'username': 'john'})
+
+    user = manager.findUser('cached')
+    assert user.username == 'john'
+    assert gl.users.list.call_count == 0
 
 
 def test_find_existing_milestone(mocker):
     project = fakeProject(mocker)
-    project.milestones.list.return_value = [munchify({'title': '1.0'})]
+    project.milestones.list.return_value = [munchify({
+        'id': 1, 'title': '1.0', 'state': 'active', 'due_date': None})]
     manager = GitlabManager()
     manager._project = project
+    manager._milestoneIndex = None
 
     assert manager.findMilestone('1.0').title == '1.0'
+    assert project.milestones.create.call_count == 0
 
 
-def test_find_milestone():
+def test_find_milestone(mocker):
+    project = fakeProject(mocker)
+    project.milestones.list.return_value = []
+    project.milestones.create.return_value = munchify({
+        'id': 2, 'title': '2.0', 'state': 'active', 'due_date': None})
     manager = GitlabManager()
+    manager._project = project
+    manager._milestoneIndex = None
+
     assert manager.findMilestone('2.0').title == '2.0'
+    assert manager.milestoneIndex['2.0'].id == 2
+    assert manager.cache.get('milestone', '2.0')['id'] == 2
 
 
 def test_client_upload(mocker):
-    project = munchify({
-        'upload': lambda filename, filedata: 'Gitlab attachment'
-    })
     manager = GitlabManager()
-    manager._project = project
+    manager._project = munchify({'id': 42})
+    manager._client = mocker.MagicMock()
+    manager._client.upload.return_value = {'markdown': 'Gitlab attachment'}
+    manager._attachments = {}
     attachment = mocker.MagicMock()
     attachment.id = '1'
     attachment.filename = 'blah.jpg'
-    attachment.get.return_value = 'Data'
+    attachment.iter_content.return_value = [b'Da', b'ta']
+
+    manager.prefetchAttachments([attachment])
+    assert manager.attachFile(attachment) == {'markdown': 'Gitlab attachment'}
+    assert attachment.iter_content.call_count == 1
+    args = manager._client.upload.call_args[0]
+    assert args[:2] == (42, '1_blah.jpg')
+
+    manager._attachments = {}
+    assert manager.attachFile(attachment) == {'markdown': 'Gitlab attachment'}
+    assert attachment.iter_content.call_count == 1
+
+
+def test_failed_upload_is_transferred_again(mocker):
+    manager = GitlabManager()
+    manager._project = munchify({'id': 42})
+    manager._client = mocker.MagicMock()
+    manager._client.upload.side_effect = [
+        Exception('Broken pipe'), {'markdown': 'Gitlab attachment'}]
+    manager._attachments = {}
+    attachment = mocker.MagicMock()
+    attachment.id = 'failed-once'
+    attachment.filename = 'blah.jpg'
+    attachment.iter_content.return_value = [b'Data']
+
+    with pytest.raises(Exception):
+        manager.attachFile(attachment)
+    manager.stopUploader()
+    assert manager._attachments == {}
+    assert manager.attachFile(attachment) == {'markdown': 'Gitlab attachment'}
+    assert manager._client.upload.call_count == 2
+
+
+def test_download_in_bounded_buffer(mocker):
+    a2g.attachment_buffer = 4
+    attachment = mocker.MagicMock()
+    attachment.iter_content.return_value = [b'Big ', b'content']
+
+    f, digest = GitlabManager().download(attachment)
+    with f:
+        assert f._rolled
+        assert f.read() == b'Big content'
+    assert digest == hashlib.sha256(b'Big content').hexdigest()
+    a2g.attachment_buffer = 8 * 1024 * 1024
+
+
+def test_user_index(mocker):
+    manager = GitlabManager()
+    gl = mocker.MagicMock()
+    manager._client = gl
+    manager._userIndex = None
+    gl.users.list.return_value = [
+        munchify({'id': 1, 'username': 'jdoe', 'email': 'jdoe@domain.tld'}),
+        munchify({'id': 2, 'username': 'jane'})]
+
+    assert manager.userIndex['jdoe'].id == 1
+    assert manager.userIndex['jdoe@domain.tld'].id == 1
+    assert manager.userIndex['jane'].id == 2
+    assert gl.users.list.call_count == 1
+
+
+def test_label_index(mocker):
+    project = fakeProject(mocker)
+    project.labels.list.return_value = [
+        munchify({'id': 1, 'name': 'Story', 'color': '#cccccc'})]
+    manager = GitlabManager()
+    manager._project = project
+    manager._labelIndex = None
+
+    assert manager.findLabel('Story').color == '#cccccc'
+    assert manager.findLabel('Bug').color is None
+    assert project.labels.list.call_count == 1
+    assert project.labels.get.call_count == 0
+
+
+def test_add_board_list(mocker):
+    board = mocker.MagicMock()
+    board.lists.list.return_value = [munchify({'label': {'name': 'Doing'}})]
+    manager = GitlabManager()
+    manager._boards = {None: board}
+    manager._boardLists = None
+
+    manager.addBoardList(munchify({'id': 1, 'name': 'Doing'}))
+    manager.addBoardList(munchify({'id': 2, 'name': 'Review'}))
+    manager.addBoardList(munchify({'id': 2, 'name': 'Review'}))
+
+    assert board.lists.list.call_count == 1
+    board.lists.create.assert_called_once_with({'label_id': 2})
+
+
+def test_deduplicate_uploads_by_content(mocker):
+    a2g.gitlab_dedupe_attachments = 'content'
+    manager = GitlabManager()
+    manager._project = munchify({'id': 42})
+    manager._client = mocker.MagicMock()
+    manager._client.upload.return_value = {'markdown': 'screenshot'}
+    manager._attachments = {}
+    first, second = mocker.MagicMock(), mocker.MagicMock()
+    for n, a in enumerate((first, second)):
+        a.id = 'dedupe-{}'.format(n)
+        a.filename = 'screenshot.png'
+        a.iter_content.return_value = [b'Same content']
+
+    assert manager.attachFile(first) == {'markdown': 'screenshot'}
+    assert manager.attachFile(second) == {'markdown': 'screenshot'}
+    assert second.iter_content.call_count == 1
+    assert manager._client.upload.call_count == 1
+    a2g.gitlab_dedupe_attachments = None
+
+
+def test_deduplicate_uploads_by_filename(mocker):
+    a2g.gitlab_dedupe_attachments = 'filename'
+    manager = GitlabManager()
+    manager._project = munchify({'id': 42})
+    manager._client = mocker.MagicMock()
+    manager._client.upload.return_value = {'markdown': 'log'}
+    manager._attachments = {}
+    first, second, other = [mocker.MagicMock() for n in range(3)]
+    for n, a in enumerate((first, second, other)):
+        a.id = 'trusted-{}'.format(n)
+        a.filename = 'build.log'
+        a.size = 3
+        a.iter_content.return_value = [b'Log']
+    other.iter_content.return_value = [b'Bug']
+
+    assert manager.attachFile(first) == {'markdown': 'log'}
+    assert manager.attachFile(second) == {'markdown': 'log'}
+    assert manager._client.upload.call_count == 1
+    manager.attachFile(other)
+    assert manager._client.upload.call_count == 2
+    a2g.gitlab_dedupe_attachments = None
+
+
+def test_cache_file_is_bound_to_the_project(mocker, tmpdir):
+    from atlassian2gitlab.cache import Cache
+    from atlassian2gitlab.exceptions import A2GException
+    path = str(tmpdir.join('cache.db'))
+    cache = Cache(path, scope='https://gitlab.com/group/project')
+    cache.set('label', 'Story', {'id': 1})
+    cache.clear()
+
+    Cache(path, scope='https://gitlab.com/group/project')
+    with pytest.raises(A2GException):
+        Cache(path, scope='https://gitlab.com/group/other')
+
+
+def test_rate_limited_upload_is_sent_again(mocker):
+    import io
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from atlassian2gitlab import clients
+    bodies = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers['Content-Length'])
+            bodies.append(self.rfile.read(length))
+            if len(bodies) == 1:
+                self.send_response(429)
+                self.send_header('Retry-After', '0')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = b'{"markdown": "uploaded"}'
+            self.send_response(201)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    mocker.patch.object(a2g, 'gitlab_url', 'http://127.0.0.1:{}'.format(
+        server.server_port))
+    mocker.patch.object(clients, 'TIMEOUT', 5)
+    mocker.patch.object(clients, 'upload_session', clients.mount(
+        clients.requests.Session(), retries=False))
+    manager = GitlabManager()
+    manager._project = munchify({'id': 42})
+    manager._client = clients.Gitlab()
+    f = io.BytesIO(b'Data')
+    f.read()
+
+    try:
+        assert manager.upload('1_a.txt', f) == {'markdown': 'uploaded'}
+    finally:
+        server.shutdown()
+        manager._client = None
 
-    assert manager.attachFile(attachment) == 'Gitlab attachment'
-    assert attachment.get.call_count == 1
+    assert len(bodies) == 2
+    assert b'Data' in bodies[0]
+    assert b'Data' in bodies[1]
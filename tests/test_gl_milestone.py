@@ -24,22 +24,24 @@ def fakeManager(mocker):
 
 def test_milestone(mocker):
     mgr = fakeManager(mocker)
-    mgr.project.milestones.list.return_value = [fakeGlMilestone()]
+    mgr.milestoneIndex = {'1.0': fakeGlMilestone()}
 
     mi = ProjectMilestone('1.0')
 
     assert mi.id == 1
+    assert mgr.project.milestones.create.call_count == 0
 
 
 def test_create_milestone(mocker):
     mgr = fakeManager(mocker)
-    mgr.project.milestones.list.return_value = []
+    mgr.milestoneIndex = {'1.0-rc': fakeGlMilestone()}
     mgr.project.milestones.create.return_value = fakeGlMilestone()
 
     mi = ProjectMilestone('1.0')
 
     assert mi.id == 1
     assert mgr.project.milestones.create.call_count == 1
+    assert '1.0' in mgr.milestoneIndex
 
 
 def test_fill_milestone_from_jira_sprint(mocker):
@@ -66,3 +68,19 @@ def test_fill_milestone_from_jira_version(mocker):
 
     assert mi.due_date == '2008-04-12'
     assert mi.state_event == 'close'
+
+
+def test_fill_milestone_once_per_sprint_state(mocker):
+    mgr = fakeManager(mocker)
+    mi = ProjectMilestone('1.0')
+    mi._item = mocker.MagicMock()
+    mi._item.state = 'active'
+    mi._item.due_date = None
+
+    sprint = munchify({'endDate': '2008-04-12', 'state': 'ACTIVE'})
+
+    mi.fillFromJiraSprint(sprint)
+    mi._item.due_date = '2008-04-12'
+    mi.fillFromJiraSprint(sprint)
+
+    assert mi._item.save.call_count == 1
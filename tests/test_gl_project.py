@@ -5,6 +5,12 @@ from atlassian2gitlab.gl_resources import Project
 from atlassian2gitlab.exceptions import A2GException
 
 
+def fakeListing(items):
+    class Listing(list):
+        total = len(items)
+    return {'list': lambda **kwargs: Listing(items)}
+
+
 def fakeManager(mocker):
     mock = mocker.patch('atlassian2gitlab.managers.GitlabManager')
     mgr = mock.return_value
@@ -41,16 +47,17 @@ def test_get_project(mocker):
 
 def test_nothing_to_flush(caplog, mocker):
     logging.getLogger('atlassian2gitlab').setLevel(logging.INFO)
+    mocker.patch('time.time', return_value=0)
     manager = fakeManager(mocker)
     manager.gitlab.projects.list.return_value = [
         munchify({'path_with_namespace': 'fake/project'})]
     project = Project('fake/project')
     project._item = munchify({
-        'branches': {'list': lambda all: []},
-        'tags': {'list': lambda all: []},
-        'issues': {'list': lambda all: []},
-        'labels': {'list': lambda all: []},
-        'milestones': {'list': lambda all: []},
+        'branches': fakeListing([]),
+        'tags': fakeListing([]),
+        'issues': fakeListing([]),
+        'labels': fakeListing([]),
+        'milestones': fakeListing([]),
     })
     project.flush()
     assert caplog.record_tuples == [
@@ -59,6 +66,7 @@ def test_nothing_to_flush(caplog, mocker):
 
 
 def test_flush_issues_in_complete_failure(mocker, caplog):
+    mocker.patch('time.time', return_value=0)
     manager = fakeManager(mocker)
     manager.gitlab.projects.list.return_value = [
         munchify({'path_with_namespace': 'fake/project'})]
@@ -67,11 +75,11 @@ def test_flush_issues_in_complete_failure(mocker, caplog):
     issue.delete = mocker.stub(name="issue")
     issue.delete.side_effect = Exception('Fail !')
     project._item = munchify({
-        'branches': {'list': lambda all: []},
-        'tags': {'list': lambda all: []},
-        'issues': {'list': lambda all: [issue]},
-        'labels': {'list': lambda all: []},
-        'milestones': {'list': lambda all: []},
+        'branches': fakeListing([]),
+        'tags': fakeListing([]),
+        'issues': fakeListing([issue]),
+        'labels': fakeListing([]),
+        'milestones': fakeListing([]),
     })
     project.flush()
     assert issue.delete.call_count == 1
@@ -84,6 +92,7 @@ def test_flush_issues_in_complete_failure(mocker, caplog):
 
 
 def test_flush_issues_with_failure(mocker, caplog):
+    mocker.patch('time.time', return_value=0)
     manager = fakeManager(mocker)
     manager.gitlab.projects.list.return_value = [
         munchify({'path_with_namespace': 'fake/project'})]
@@ -94,11 +103,11 @@ def test_flush_issues_with_failure(mocker, caplog):
     issue_two = munchify({'id': 2})
     issue_two.delete = mocker.stub(name="issue_two")
     project._item = munchify({
-        'branches': {'list': lambda all: []},
-        'tags': {'list': lambda all: []},
-        'issues': {'list': lambda all: [issue_one, issue_two]},
-        'labels': {'list': lambda all: []},
-        'milestones': {'list': lambda all: []},
+        'branches': fakeListing([]),
+        'tags': fakeListing([]),
+        'issues': fakeListing([issue_one, issue_two]),
+        'labels': fakeListing([]),
+        'milestones': fakeListing([]),
     })
     project.flush()
     assert issue_one.delete.call_count == 1
@@ -112,6 +121,7 @@ def test_flush_issues_with_failure(mocker, caplog):
 
 
 def test_flush_milestones_in_complete_failure(mocker, caplog):
+    mocker.patch('time.time', return_value=0)
     manager = fakeManager(mocker)
     manager.gitlab.projects.list.return_value = [
         munchify({'path_with_namespace': 'fake/project'})]
@@ -120,11 +130,11 @@ def test_flush_milestones_in_complete_failure(mocker, caplog):
     milestone.delete = mocker.stub(name="milestone")
     milestone.delete.side_effect = Exception('Fail !')
     project._item = munchify({
-        'branches': {'list': lambda all: []},
-        'tags': {'list': lambda all: []},
-        'issues': {'list': lambda all: []},
-        'labels': {'list': lambda all: []},
-        'milestones': {'list': lambda all: [milestone]}
+        'branches': fakeListing([]),
+        'tags': fakeListing([]),
+        'issues': fakeListing([]),
+        'labels': fakeListing([]),
+        'milestones': fakeListing([milestone])
     })
     project.flush()
     assert milestone.delete.call_count == 1
@@ -137,6 +147,7 @@ def test_flush_milestones_in_complete_failure(mocker, caplog):
 
 
 def test_flush_milestones_with_failure(mocker, caplog):
+    mocker.patch('time.time', return_value=0)
     manager = fakeManager(mocker)
     manager.gitlab.projects.list.return_value = [
         munchify({'path_with_namespace': 'fake/project'})]
@@ -147,11 +158,11 @@ def test_flush_milestones_with_failure(mocker, caplog):
     milestone_two = munchify({'title': 'Sprint 2'})
     milestone_two.delete = mocker.stub(name="milestone_two")
     project._item = munchify({
-        'branches': {'list': lambda all: []},
-        'tags': {'list': lambda all: []},
-        'issues': {'list': lambda all: []},
-        'labels': {'list': lambda all: []},
-        'milestones': {'list': lambda all: [milestone_one, milestone_two]}
+        'branches': fakeListing([]),
+        'tags': fakeListing([]),
+        'issues': fakeListing([]),
+        'labels': fakeListing([]),
+        'milestones': fakeListing([milestone_one, milestone_two])
     })
     project.flush()
     assert milestone_one.delete.call_count == 1
@@ -165,6 +176,7 @@ def test_flush_milestones_with_failure(mocker, caplog):
 
 
 def test_flush_labels_in_complete_failure(mocker, caplog):
+    mocker.patch('time.time', return_value=0)
     manager = fakeManager(mocker)
     manager.gitlab.projects.list.return_value = [
         munchify({'path_with_namespace': 'fake/project'})]
@@ -173,11 +185,11 @@ def test_flush_labels_in_complete_failure(mocker, caplog):
     label.delete = mocker.stub(name="label")
     label.delete.side_effect = Exception('Fail !')
     project._item = munchify({
-        'branches': {'list': lambda all: []},
-        'tags': {'list': lambda all: []},
-        'issues': {'list': lambda all: []},
-        'labels': {'list': lambda all: [label]},
-        'milestones': {'list': lambda all: []}
+        'branches': fakeListing([]),
+        'tags': fakeListing([]),
+        'issues': fakeListing([]),
+        'labels': fakeListing([label]),
+        'milestones': fakeListing([])
     })
     project.flush()
     assert label.delete.call_count == 1
@@ -190,6 +202,7 @@ def test_flush_labels_in_complete_failure(mocker, caplog):
 
 
 def test_flush_labels_with_failure(mocker, caplog):
+    mocker.patch('time.time', return_value=0)
     manager = fakeManager(mocker)
     manager.gitlab.projects.list.return_value = [
         munchify({'path_with_namespace': 'fake/project'})]
@@ -200,11 +213,11 @@ def test_flush_labels_with_failure(mocker, caplog):
     label_two = munchify({'name': 'In Progress'})
     label_two.delete = mocker.stub(name="label_two")
     project._item = munchify({
-        'branches': {'list': lambda all: []},
-        'tags': {'list': lambda all: []},
-        'issues': {'list': lambda all: []},
-        'labels': {'list': lambda all: [label_one, label_two]},
-        'milestones': {'list': lambda all: []}
+        'branches': fakeListing([]),
+        'tags': fakeListing([]),
+        'issues': fakeListing([]),
+        'labels': fakeListing([label_one, label_two]),
+        'milestones': fakeListing([])
     })
     project.flush()
     assert label_one.delete.call_count == 1
@@ -218,6 +231,7 @@ def test_flush_labels_with_failure(mocker, caplog):
 
 
 def test_flush(mocker, caplog):
+    mocker.patch('time.time', return_value=0)
     manager = fakeManager(mocker)
     manager.gitlab.projects.list.return_value = [
         munchify({'path_with_namespace': 'fake/project'})]
@@ -236,11 +250,11 @@ def test_flush(mocker, caplog):
     milestone.delete = mocker.stub(name="milestone")
     project._item = munchify({
         'default_branch': 'master',
-        'branches': {'list': lambda all: [branch_dev, branch_master]},
-        'tags': {'list': lambda all: [tag]},
-        'issues': {'list': lambda all: [issue]},
-        'labels': {'list': lambda all: [label]},
-        'milestones': {'list': lambda all: [milestone]}
+        'branches': fakeListing([branch_dev, branch_master]),
+        'tags': fakeListing([tag]),
+        'issues': fakeListing([issue]),
+        'labels': fakeListing([label]),
+        'milestones': fakeListing([milestone])
     })
     project.flush()
     assert issue.delete.call_count == 1
@@ -251,15 +265,124 @@ def test_flush(mocker, caplog):
     assert tag.delete.call_count == 1
     assert caplog.record_tuples == [
         ('atlassian2gitlab', logging.INFO, '1 issues to be deleted'),
-        ('atlassian2gitlab', logging.INFO, 'Done'),
+        ('atlassian2gitlab', logging.INFO,
+            'Done, 1 issues deleted in 0.0s (1000.0/s)'),
         ('atlassian2gitlab', logging.INFO, '1 labels to be deleted'),
-        ('atlassian2gitlab', logging.INFO, 'Done'),
+        ('atlassian2gitlab', logging.INFO,
+            'Done, 1 labels deleted in 0.0s (1000.0/s)'),
         ('atlassian2gitlab', logging.INFO, '1 milestones to be deleted'),
-        ('atlassian2gitlab', logging.INFO, 'Done'),
+        ('atlassian2gitlab', logging.INFO,
+            'Done, 1 milestones deleted in 0.0s (1000.0/s)'),
         ('atlassian2gitlab', logging.INFO, '1 tags to be deleted'),
-        ('atlassian2gitlab', logging.INFO, 'Done'),
+        ('atlassian2gitlab', logging.INFO,
+            'Done, 1 tags deleted in 0.0s (1000.0/s)'),
         ('atlassian2gitlab', logging.INFO, '2 branches to be deleted'),
         ('atlassian2gitlab', logging.WARNING,
             "Skip the default branch `master'"),
-        ('atlassian2gitlab', logging.INFO, 'Done'),
+        ('atlassian2gitlab', logging.INFO,
+            'Done, 2 branches deleted in 0.0s (2000.0/s)'),
     ]
+
+
+def test_flush_lists_pages_again_while_deleting(mocker):
+    manager = fakeManager(mocker)
+    manager.gitlab.projects.list.return_value = [
+        munchify({'path_with_namespace': 'fake/project'})]
+    project = Project('fake/project')
+    mocker.patch.object(Project, 'FLUSH_PAGE', 2)
+    issues = []
+    for id in range(5):
+        issue = munchify({'id': id})
+        issue.delete = (lambda i: lambda: issues.remove(i))(issue)
+        issues.append(issue)
+    issues[0].delete = mocker.stub()
+    issues[0].delete.side_effect = Exception('Fail !')
+
+    def list(page=1, per_page=20, **kwargs):
+        return issues[(page - 1) * per_page:page * per_page]
+    project._item = munchify({
+        'branches': fakeListing([]),
+        'tags': fakeListing([]),
+        'issues': {'list': list},
+        'labels': fakeListing([]),
+        'milestones': fakeListing([])
+    })
+    project.flush()
+    assert [i.id for i in issues] == [0]
+
+
+def test_flush_by_recreating_the_project(mocker):
+    mocker.patch('atlassian2gitlab.gitlab_destroy_project_on_flush', True)
+    mocker.patch('time.sleep')
+    manager = fakeManager(mocker)
+    item = munchify({
+        'path_with_namespace': 'fake/project',
+        'name': 'Project', 'path': 'project', 'namespace': {'id': 3},
+        'visibility': 'private', 'description': 'Blah',
+        'permissions': {
+            'project_access': None,
+            'group_access': {'access_level': 50}}})
+    item.delete = mocker.stub()
+    manager.gitlab.projects.list.return_value = [item]
+    manager.gitlab.projects.create.side_effect = [
+        Exception('Has already been taken'), munchify({'id': 2})]
+    manager.gitlab.projects.get.side_effect = Exception('404 Not Found')
+    project = Project('fake/project')
+
+    project.flush()
+    assert item.delete.call_count == 1
+    assert project.id == 2
+    manager.gitlab.projects.create.assert_called_with({
+        'name': 'Project', 'path': 'project', 'namespace_id': 3,
+        'visibility': 'private', 'description': 'Blah'})
+
+
+def test_not_owner_cannot_recreate_the_project(mocker):
+    manager = fakeManager(mocker)
+    item = munchify({
+        'path_with_namespace': 'fake/project',
+        'permissions': {'project_access': {'access_level': 40}}})
+    manager.gitlab.projects.list.return_value = [item]
+    project = Project('fake/project')
+
+    assert project.recreate() is False
+    assert manager.gitlab.projects.create.call_count == 0
+
+
+def test_project_not_created_again_is_not_deleted(mocker):
+    manager = fakeManager(mocker)
+    item = munchify({
+        'path_with_namespace': 'jdoe/project',
+        'namespace': {'id': 3, 'kind': 'user'},
+        'permissions': {'project_access': {'access_level': 50}}})
+    item.delete = mocker.stub()
+    manager.gitlab.projects.list.return_value = [item]
+    manager.gitlab.user = munchify({'can_create_project': False})
+    project = Project('jdoe/project')
+
+    assert project.recreate() is False
+    assert item.delete.call_count == 0
+
+
+def test_project_marked_for_deletion_is_restored(mocker):
+    manager = fakeManager(mocker)
+    item = munchify({
+        'id': 1, 'path_with_namespace': 'fake/project',
+        'name': 'Project', 'path': 'project', 'namespace': {'id': 3},
+        'visibility': 'private', 'description': 'Blah',
+        'permissions': {'group_access': {'access_level': 50}}})
+    item.delete = mocker.stub()
+    marked = mocker.MagicMock(
+        marked_for_deletion_on='2018-06-08',
+        path_with_namespace='fake/project-deletion_scheduled-1')
+    marked.delete.side_effect = Exception('403 Forbidden')
+    manager.gitlab.projects.list.return_value = [item]
+    manager.gitlab.projects.get.return_value = marked
+    project = Project('fake/project')
+
+    assert project.recreate() is False
+    marked.delete.assert_called_once_with(
+        permanently_remove=True,
+        full_path='fake/project-deletion_scheduled-1')
+    assert marked.restore.call_count == 1
+    assert manager.gitlab.projects.create.call_count == 0
@@ -1,4 +1,5 @@
 import pytest
+import atlassian2gitlab as a2g
 from atlassian2gitlab.gl_resources import User
 from atlassian2gitlab.exceptions import A2GException
 from munch import munchify
@@ -32,3 +33,16 @@ def test_get_user(mocker):
     manager.gitlab.users.list.return_value = ['blah']
     user = User('name')
     assert user.get() == 'blah'
+
+
+def test_get_user_from_prefetched_directory(mocker):
+    a2g.gitlab_prefetch_users = True
+    manager = fakeManager(mocker)
+    manager.userIndex = {'name': 'blah'}
+    user = User('name')
+    assert user.get() == 'blah'
+    assert manager.gitlab.users.list.call_count == 0
+
+    with pytest.raises(A2GException):
+        User('other').get()
+    a2g.gitlab_prefetch_users = False
@@ -107,3 +107,102 @@ def test_copy_jira_issues(caplog, mocker):
         ('atlassian2gitlab', logging.INFO, '1 issues to migrate'),
         ('atlassian2gitlab', logging.INFO, 'All done')
     ]
+
+
+def test_find_issues_page_by_page(mocker):
+    a2g.jira_page_size = 2
+    manager = JiraManager()
+    manager._client = mocker.MagicMock()
+    manager._client.fields.return_value = [
+        {'name': 'Sprint', 'id': 'field1'},
+        {'name': 'Story Points', 'id': 'field2'},
+    ]
+    first = mocker.MagicMock()
+    first.__iter__.return_value = ['PRO-1', 'PRO-2']
+    first.__len__.return_value = 2
+    first.total = 3
+    manager._client.search_issues.side_effect = [first, ['PRO-3']]
+
+    issues = manager.findIssues('project = PRO')
+
+    assert len(issues) == 3
+    assert list(issues) == ['PRO-1', 'PRO-2', 'PRO-3']
+    assert manager._client.search_issues.call_count == 2
+    assert manager._client.search_issues.call_args[1]['startAt'] == 2
+    a2g.jira_page_size = 100
+
+
+def test_copy_jira_issues_with_workers(caplog, mocker):
+    a2g.workers = 4
+    manager = JiraManager()
+    issues = [munchify({
+        'key': 'PRO-{}'.format(n),
+        'fields': {'issuetype': {'name': 'Story'}}}) for n in range(10)]
+    manager._client = mocker.MagicMock()
+    manager._client.fields.return_value = [
+        {'name': 'Sprint', 'id': 'field1'},
+        {'name': 'Story Points', 'id': 'field2'},
+    ]
+    manager._client.search_issues.return_value = issues
+    project = mocker.patch('atlassian2gitlab.gl_resources.Project')
+    GitlabManager()._project = project
+
+    manager.cp()
+    a2g.workers = 1
+
+    assert project.addIssue.call_count == 10
+    assert caplog.record_tuples[-1] == (
+        'atlassian2gitlab', logging.INFO, 'All done')
+
+
+def test_find_sprint_from_board(mocker):
+    manager = JiraManager()
+    manager._client = mocker.MagicMock()
+    manager._boards = set()
+    manager._sprints = {}
+    manager._client.sprints.return_value = [
+        munchify({'id': 1, 'name': 'Sprint 1'}),
+        munchify({'id': 2, 'name': 'Sprint 2'})]
+
+    assert manager.findSprint('1', '7').name == 'Sprint 1'
+    assert manager.findSprint('2', '7').name == 'Sprint 2'
+    manager._client.sprints.assert_called_once_with(7, maxResults=False)
+    assert manager._client.sprint.call_count == 0
+
+    manager.findSprint(3)
+    manager.findSprint(3)
+    manager._client.sprint.assert_called_once_with(3)
+
+
+def test_copy_jira_issues_updated_since_last_run(caplog, mocker):
+    from atlassian2gitlab.cache import Cache
+    mocker.patch.object(a2g, 'since', 'last')
+    mocker.patch.object(a2g, 'jira_jql', 'project = PRO ORDER BY key')
+    manager = JiraManager()
+    manager._client = mocker.MagicMock()
+    manager._client.fields.return_value = [
+        {'name': 'Sprint', 'id': 'field1'},
+        {'name': 'Story Points', 'id': 'field2'},
+    ]
+    manager._client.search_issues.return_value = []
+    manager._client.server_info.return_value = {
+        'serverTime': '2018-06-08T10:30:45.123+0000'}
+    manager._client.myself.return_value = {'timeZone': 'Europe/Paris'}
+    cache = Cache()
+    mocker.patch.object(GitlabManager(), '_cache', cache)
+
+    manager.cp()
+
+    jql = manager._client.search_issues.call_args[0][0]
+    assert jql == 'project = PRO ORDER BY key'
+    since = cache.get('sync', 'project = PRO ORDER BY key')
+    assert since == '2018-06-08T12:30:45.123000'
+
+    manager.cp()
+
+    jql = manager._client.search_issues.call_args[0][0]
+    assert jql.startswith('(project = PRO) AND updated >= "')
+    assert jql.endswith('" ORDER BY key')
+    assert caplog.record_tuples[-2] == (
+        'atlassian2gitlab', logging.INFO,
+        'Migrate the issues updated since {}'.format(since))
@@ -0,0 +1,171 @@
+import pytest
+from munch import munchify
+import atlassian2gitlab as a2g
+from atlassian2gitlab import pipeline
+from atlassian2gitlab.gl_resources import Issue, Label
+
+
+def fakeRecord(key='PRO-1'):
+    return {
+        'key': key,
+        'permalink': 'http://url/',
+        'story_points': 8,
+        'sprint': {'name': 'Sprint 1', 'state': 'CLOSED',
+                   'endDate': '2008-05-01'},
+        'fields': {
+            'created': '2008-04-12 21:00:00',
+            'summary': 'Title',
+            'reporter': {'name': 'jdoe'},
+            'assignee': None,
+            'labels': ['backend'],
+            'description': 'See !a.png! with [~jdoe]',
+            'attachment': [{'filename': 'a.png'}],
+            'fixVersions': [{'name': '1.0', 'released': True}],
+            'issuetype': {'name': 'Story', 'iconUrl': 'http://url'},
+            'status': {
+                'name': 'In Progress',
+                'statusCategory': {
+                    'key': 'indeterminate', 'colorName': 'yellow'}},
+            'comment': {'comments': [{
+                'id': '10000',
+                'body': '*Done*',
+                'created': '12/Apr/2008 9 PM',
+                'author': {'key': 'jsmith'}}]},
+            'resolution': {'name': 'Fixed'},
+            'resolutiondate': '2012-12-12 12:12',
+        },
+    }
+
+
+def test_transform_builds_a_plain_payload():
+    payload = pipeline.transform(fakeRecord(), {'storyPoint_map': {8: 5}})
+
+    assert payload == {
+        'key': 'PRO-1',
+        'permalink': 'http://url/',
+        'title': 'Title',
+        'created_at': '2008-04-12T21:00:00',
+        'reporter': 'jdoe',
+        'assignee': None,
+        'description':
+            'See \ue001attachment=a.png\ue001 with \ue001user=jdoe\ue001',
+        'milestone': {
+            'title': 'Sprint 1', 'state': 'closed', 'due_date': '2008-05-01'},
+        'weight': 5,
+        'labels': [
+            {'name': 'backend'},
+            {'name': 'Story', 'iconUrl': 'http://url'}],
+        'notes': [{
+            'id': '10000',
+            'author': 'jsmith',
+            'body': '**Done**',
+            'created_at': '2008-04-12T21:00:00'}],
+        'closed_at': '2012-12-12T12:12:00',
+    }
+
+
+def test_stages_keep_the_order_and_the_failures(mocker):
+    def extract(issue):
+        if issue.key == 'PRO-2':
+            raise Exception('No sprint')
+        return fakeRecord(issue.key)
+    mocker.patch('atlassian2gitlab.pipeline.extract', side_effect=extract)
+    issues = [munchify({'key': 'PRO-%d' % n}) for n in range(1, 5)]
+
+    results = []
+    for issue, future in pipeline.stages(issues, processes=2, backlog=1):
+        try:
+            results.append((issue.key, future.result()['key']))
+        except Exception as e:
+            results.append((issue.key, str(e)))
+
+    assert results == [
+        ('PRO-1', 'PRO-1'),
+        ('PRO-2', 'No sprint'),
+        ('PRO-3', 'PRO-3'),
+        ('PRO-4', 'PRO-4')]
+
+
+def test_stages_raise_when_issues_can_not_be_read(mocker):
+    mocker.patch('atlassian2gitlab.pipeline.extract',
+                 side_effect=lambda issue: fakeRecord(issue.key))
+
+    def issues():
+        yield munchify({'key': 'PRO-1'})
+        raise Exception('Jira unavailable')
+
+    keys = []
+    with pytest.raises(Exception, match='Jira unavailable'):
+        for issue, future in pipeline.stages(issues(), processes=1):
+            keys.append(future.result()['key'])
+    assert keys == ['PRO-1']
+
+
+def test_load_payload(mocker):
+    a2g.jira_link_to_source = True
+    a2g.resume = False
+    payload = pipeline.transform(fakeRecord())
+    payload['labels'].append(
+        {'name': 'In Progress', 'colorname': 'yellow', 'board': True})
+    jira_issue = munchify({'key': 'PRO-1', 'fields': {
+        'attachment': [{'filename': 'a.png'}]}})
+
+    mgr = mocker.patch('atlassian2gitlab.managers.GitlabManager').return_value
+    users = {'jdoe': 'john', 'jsmith': 'jane'}
+    mgr.findUser.side_effect = lambda name: munchify(
+        {'id': 1, 'username': users[name]})
+    mgr.attachFile.return_value = {'markdown': '![a](/uploads/a.png)'}
+    labels = {}
+    for name in ('backend', 'Story', 'In Progress'):
+        labels[name] = Label(name)
+        labels[name].color = '#cccccc'
+    mgr.findLabel.side_effect = labels.get
+    milestone = mocker.MagicMock(id=7)
+    mgr.findMilestone.return_value = milestone
+    gl_issue = mgr.project.issues.create.return_value
+
+    Issue().fillFromPayload(jira_issue, payload)
+
+    mgr.prefetchAttachments.assert_called_once_with(
+        [{'filename': 'a.png'}])
+    mgr.project.issues.create.assert_called_once_with({
+        'created_at': '2008-04-12T21:00:00',
+        'title': 'Title',
+        'assignee_ids': [],
+        'description': 'See ![a](/uploads/a.png) with @john',
+        'milestone_id': 7,
+        'weight': 5,
+        'labels': ['backend', 'Story', 'In Progress']}, sudo='john')
+    milestone._fill.assert_called_once_with('closed', '2008-05-01')
+    mgr.addBoardList.assert_called_once_with(labels['In Progress'])
+    gl_issue.notes.create.assert_has_calls([
+        mocker.call(
+            {'body': '**Done**', 'created_at': '2008-04-12T21:00:00'},
+            sudo='jane'),
+        mocker.call({'body': 'Imported from [PRO-1](http://url/)'})])
+    assert gl_issue.state_event == 'close'
+    assert gl_issue.updated_at == '2012-12-12T12:12:00'
+
+
+@pytest.mark.parametrize('processes', [0, 2])
+def test_copy_with_or_without_pipeline(mocker, processes):
+    from atlassian2gitlab.managers import JiraManager, GitlabManager
+    mocker.patch.object(a2g, 'transform_processes', processes)
+    mocker.patch.object(a2g, 'progress_interval', 0)
+    mocker.patch('atlassian2gitlab.pipeline.extract',
+                 side_effect=lambda issue: fakeRecord(issue.key))
+    issue = munchify({
+        'key': 'PRO-42',
+        'fields': {'issuetype': {'name': 'Story'}}})
+    project = mocker.MagicMock()
+    mocker.patch.object(GitlabManager(), '_project', project)
+
+    JiraManager().cp([issue])
+
+    if processes:
+        assert not project.addIssue.called
+        loaded, payload = project.loadIssue.call_args[0]
+        assert loaded is issue
+        assert payload['key'] == 'PRO-42'
+    else:
+        project.addIssue.assert_called_once_with(issue)
@@ -0,0 +1,41 @@
+import json
+from atlassian2gitlab.profiling import Profiler
+
+
+def test_disabled_profiler_records_nothing():
+    profiler = Profiler()
+
+    @profiler.timed('work')
+    def work():
+        return 42
+
+    assert work() == 42
+    assert profiler.export() == {}
+    assert profiler.folded() == ''
+
+
+def test_dump_histograms_and_stacks(tmpdir, mocker):
+    clock = mocker.patch('time.perf_counter')
+    clock.side_effect = [0.0, 0.001, 0.003, 0.010]
+    profiler = Profiler()
+    profiler.enabled = True
+
+    @profiler.timed('Issue.save')
+    def save():
+        with profiler.span('HTTP POST /projects/:id/issues'):
+            pass
+
+    save()
+    prefix = str(tmpdir.join('profile'))
+    profiler.dump(prefix)
+
+    with open(prefix + '.json') as f:
+        histograms = json.load(f)
+    assert histograms['Issue.save']['count'] == 1
+    assert histograms['Issue.save']['buckets'] == {'<=16ms': 1}
+    assert histograms['HTTP POST /projects/:id/issues']['buckets'] == {
+        '<=2ms': 1}
+    with open(prefix + '.folded') as f:
+        assert f.read() == (
+            'Issue.save 8000\n'
+            'Issue.save;HTTP POST /projects/:id/issues 2000\n')
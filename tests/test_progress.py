@@ -0,0 +1,63 @@
+import io
+import logging
+from atlassian2gitlab.progress import Progress
+
+
+class fakeTTY(io.StringIO):
+    def isatty(self):
+        return True
+
+
+def test_report_in_place_on_tty(mocker):
+    mocker.patch('time.time', return_value=0)
+    stream = fakeTTY()
+    progress = Progress()
+    progress.start(4, interval=3600, stream=stream)
+    progress.count('issues', 2)
+    progress.count('notes', 10)
+    progress.count('attachment_bytes', 1024 ** 2)
+    progress.latency(0.25)
+    mocker.patch('time.time', return_value=10)
+
+    with progress.phase('notes'):
+        progress.report()
+    progress.stop()
+
+    assert stream.getvalue() == (
+        '\r\033[K2/4 issues, 0.20 issues/s, 1.00 notes/s, 0.10 MB/s, '
+        'API p50 250ms p90 250ms p99 250ms, ETA 00:00:10, in notes:1')
+
+
+def test_eta_of_several_days(mocker):
+    mocker.patch('time.time', return_value=0)
+    progress = Progress()
+    progress.start(10000, interval=3600, stream=io.StringIO())
+    progress.count('issues')
+    mocker.patch('time.time', return_value=10)
+
+    line = progress.format(progress.snapshot())
+    progress.stop()
+
+    assert line.endswith('ETA 1d 03:46:30')
+
+
+def test_report_in_log_lines(mocker, caplog):
+    logger = logging.getLogger('atlassian2gitlab')
+    logger.setLevel(logging.INFO)
+    # A logging config loaded by another test disables existing loggers
+    mocker.patch.object(logger, 'disabled', False)
+    mocker.patch('time.time', return_value=0)
+    progress = Progress()
+    progress.start(None, interval=3600, stream=io.StringIO())
+    progress.extras['gitlab'] = lambda: '10 requests/s'
+    progress.count('issues')
+    mocker.patch('time.time', return_value=2.0)
+
+    progress.report()
+    progress.stop()
+
+    assert caplog.record_tuples == [(
+        'atlassian2gitlab', logging.INFO,
+        'progress issues=1 skipped=0 failed=0 total= elapsed=2.000 '
+        'issues_per_s=0.500 notes_per_s=0.000 attachments_mb_per_s=0.000 '
+        'phases= eta= p50= p90= p99= gitlab="10 requests/s"')]